@@ -0,0 +1,349 @@
+# Benchmarks for the Lassa Fever model.
+#
+#   python3 disease_benchmark.py run --out before.json
+#
+# runs the benchmark suite: for every combination of population size (humans
+# and rodents), grid size and parameter regime it measures how long
+# Disease_Model takes to set up, how fast it steps (steps per second and
+# agent-steps per second), what datacollector.collect costs, and the peak
+# memory of the run. Each case is run several times, and the median kept
+# along with how much the runs disagreed (the measurement's noise).
+# Results are saved as JSON, and
+#
+#   python3 disease_benchmark.py compare before.json after.json
+#
+# lists every measurement that got worse by more than a threshold (10% by
+# default) and by more than its noise between two runs, exiting with status
+# 1 if there are any.
+#
+#   python3 disease_benchmark.py startup
+#
+# times how long Disease_Model takes to set up (create and place every
+# agent) for populations from 10^5 to 10^6 agents, and
+#
+#   python3 disease_benchmark.py memory
+#
+# measures how much memory each agent takes up.
+import argparse
+import datetime
+import gc
+import itertools
+import json
+import math
+import multiprocessing
+import platform
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import mesa
+import numpy as np
+
+from disease_model import Disease_Model
+
+# Default model parameters used by the benchmarks (the slider defaults from
+# disease_server.py). Population and grid size are set per benchmark.
+BENCHMARK_PARAMS = {"initial_infection":0.9, "transmissibility":1, "level_of_movement":0.56,
+                    "mean_length_of_disease":18, "treatment_chance":35, "treatment_length":40,
+                    "isolation":60, "environmental":0, "pesticide":0}
+
+# Parameter regimes the suite runs each population and grid size under -
+# changes from BENCHMARK_PARAMS that stress different parts of a step
+REGIMES = {"default":{},
+           # most rodents die early on, so most of the work is pruning them
+           "high_pesticide":{"pesticide":30},
+           # nobody moves, so stepping is all infection and countdowns
+           "no_movement":{"level_of_movement":0},
+           # every rodent starts infected and few humans are treated, so
+           # almost everyone is exposed and infected
+           "high_transmissibility":{"initial_infection":1, "transmissibility":1, "treatment_chance":1}}
+
+# The measurements made for each case, and whether a higher value is better
+METRICS = {"construct_seconds":False,
+           "steps_per_second":True,
+           "agent_steps_per_second":True,
+           "collect_microseconds":False,
+           "peak_memory_bytes":False}
+
+# datacollector.collect is timed in COLLECT_BATCHES batches of
+# COLLECT_CALLS calls each (a call takes around a microsecond, far too
+# little to time on its own), keeping the fastest batch
+COLLECT_BATCHES = 20
+COLLECT_CALLS = 100
+
+
+# Time a fixed piece of work (best of three tries) that nothing in the
+# model changes, to tell how fast the machine is running at the moment.
+# On a shared machine this changes by tens of percent from one second to
+# the next, which would swamp the changes the benchmarks are looking for.
+def reference_seconds():
+  best = math.inf
+  for attempt in range(3):
+    start = time.perf_counter()
+    total = 0
+    for i in range(50000):
+      total += i * i
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+# Model parameters for a population of num_agents, split evenly between
+# humans and rodents, on a square grid with roughly `density` agents per cell
+def population_params(num_agents, density=1.0):
+  side = max(1, int(math.ceil(math.sqrt(num_agents / density))))
+  return dict(BENCHMARK_PARAMS, N=num_agents // 2, rodent_population=num_agents - num_agents // 2,
+              width=side, height=side)
+
+
+# The model parameters for a case of the suite
+def case_params(humans, rodents, grid_size, regime):
+  params = dict(BENCHMARK_PARAMS, N=humans, rodent_population=rodents, width=grid_size, height=grid_size)
+  params.update(REGIMES[regime])
+  return params
+
+
+# Time one run of a case: set up a model, step it, then time extra
+# datacollector.collect calls. As with timeit, the garbage collector is
+# switched off while timing, so it doesn't run at a different point in
+# each run. The reference work is timed either side of the run, to tell
+# how fast the machine was running at the time.
+def time_case(params, steps, seed=0):
+  reference = reference_seconds()
+  gc.collect()
+  gc.disable()
+  try:
+    start = time.perf_counter()
+    model = Disease_Model(**params, seed=seed)
+    construct_seconds = time.perf_counter() - start
+
+    step_seconds = []
+    agents = []
+    for i in range(steps):
+      agents.append(model.schedule.get_agent_count())
+      start = time.perf_counter()
+      model.step()
+      step_seconds.append(time.perf_counter() - start)
+
+    collect_seconds = []
+    for batch in range(COLLECT_BATCHES):
+      start = time.perf_counter()
+      for i in range(COLLECT_CALLS):
+        model.datacollector.collect(model)
+      collect_seconds.append((time.perf_counter() - start) / COLLECT_CALLS)
+  finally:
+    gc.enable()
+  return {"construct_seconds":construct_seconds, "step_seconds":step_seconds, "agents":agents,
+          "collect_seconds":min(collect_seconds), "reference_seconds":min(reference, reference_seconds())}
+
+
+# The peak memory of a run of a case. This is measured in its own run, as
+# tracing memory slows everything else down.
+def peak_memory(params, steps, seed=0):
+  tracemalloc.start()
+  model = Disease_Model(**params, seed=seed)
+  for i in range(steps):
+    model.step()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  del model
+  return peak
+
+
+# Combine several timed runs of a case (from time_case) into its results.
+# Each run's times are first scaled to what they would have been with the
+# machine running at `reference` (the fastest the reference work ran during
+# the benchmark), then the median of the runs is taken for each
+# measurement. Every run has the same seed, so step i is the same work in
+# each, and the median is taken for each step separately.
+#
+# How much the runs disagree is kept as each measurement's noise: the gap
+# between its fastest and slowest run, as a fraction of the median.
+def case_results(humans, rodents, grid_size, regime, steps, runs, peak_memory_bytes, reference):
+  def scaled(run, seconds):
+    return seconds * reference / run["reference_seconds"]
+
+  def noise(times):
+    return float((np.max(times) - np.min(times)) / np.median(times))
+
+  step_times = np.array([[scaled(run, seconds) for seconds in run["step_seconds"]] for run in runs])
+  construct_times = [scaled(run, run["construct_seconds"]) for run in runs]
+  collect_times = [scaled(run, run["collect_seconds"]) for run in runs]
+  step_seconds = float(np.median(step_times, axis=0).sum())
+  agent_steps = sum(runs[0]["agents"])
+  return {"humans":humans, "rodents":rodents, "grid_size":grid_size, "regime":regime, "steps":steps,
+          "repeats":len(runs),
+          "construct_seconds":float(np.median(construct_times)),
+          "steps_per_second":steps / step_seconds,
+          "agent_steps_per_second":agent_steps / step_seconds,
+          "collect_microseconds":1e6 * float(np.median(collect_times)),
+          "peak_memory_bytes":peak_memory_bytes,
+          "noise":{"construct_seconds":noise(construct_times),
+                   "steps_per_second":noise(step_times.sum(axis=1)),
+                   "agent_steps_per_second":noise(step_times.sum(axis=1)),
+                   "collect_microseconds":noise(collect_times)}}
+
+
+# Benchmark one case of the suite: one untimed run to warm up, then
+# `repeats` timed runs
+def benchmark_case(humans, rodents, grid_size, regime, steps, seed=0, repeats=5):
+  params = case_params(humans, rodents, grid_size, regime)
+  time_case(params, steps, seed)
+  runs = [time_case(params, steps, seed) for repeat in range(repeats)]
+  reference = min(run["reference_seconds"] for run in runs)
+  return case_results(humans, rodents, grid_size, regime, steps, runs, peak_memory(params, steps, seed), reference)
+
+
+# Time one run of each case, after an untimed run of the first to warm up
+def time_cases(cases, steps, seed=0):
+  time_case(case_params(*cases[0]), steps, seed)
+  return [time_case(case_params(*case), steps, seed) for case in cases]
+
+
+# Run the whole suite and return the results along with details of the
+# machine and versions they were run on. How fast a shared machine runs
+# can change from one second to the next, and some timings depend on
+# where a process happens to lay out its memory, so rather than running
+# each case `repeats` times in a row, the suite is run through `repeats`
+# times, each in a new process. This spreads each case's runs over the
+# whole benchmark and over several processes (and times are scaled to the
+# fastest the machine ran at; see case_results). Each case is printed once
+# its results are in.
+def run_suite(humans=(1000, 5000), rodents=(1000, 5000), grid_sizes=(50, 100), regimes=tuple(REGIMES), steps=20, seed=0, repeats=5):
+  cases = list(itertools.product(humans, rodents, grid_sizes, regimes))
+  runs = {case:[] for case in cases}
+  for repeat in range(repeats):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+      for case, run in zip(cases, pool.submit(time_cases, cases, steps, seed).result()):
+        runs[case].append(run)
+
+  reference = min(run["reference_seconds"] for case in cases for run in runs[case])
+  results = []
+  for case in cases:
+    result = case_results(*case, steps, runs[case], peak_memory(case_params(*case), steps, seed), reference)
+    print("{humans} humans, {rodents} rodents, {grid_size}x{grid_size}, {regime}: {steps_per_second:.1f} steps/s, "
+          "{agent_steps_per_second:.0f} agent-steps/s".format(**result))
+    results.append(result)
+  return {"meta":{"python":platform.python_version(), "mesa":mesa.__version__, "platform":platform.platform(),
+                  "time":datetime.datetime.now().isoformat(timespec="seconds"), "reference_seconds":reference},
+          "results":results}
+
+
+# Compare two runs of the suite. Returns a list of (case, metric, old value,
+# new value, relative change) for every measurement in a case present in
+# both runs that got worse by more than `threshold` (a fraction). On a
+# noisy machine a measurement has to get worse by more than its noise in
+# either run, too, so that noise isn't reported as a regression.
+def compare_results(old, new, threshold=0.1):
+  def case_key(result):
+    return (result["humans"], result["rodents"], result["grid_size"], result["regime"], result["steps"])
+
+  old_results = {case_key(result):result for result in old["results"]}
+  regressions = []
+  for result in new["results"]:
+    key = case_key(result)
+    if key not in old_results:
+      continue
+    for metric, higher_is_better in METRICS.items():
+      old_value = old_results[key][metric]
+      new_value = result[metric]
+      if old_value == 0:
+        continue
+      change = (new_value - old_value) / old_value
+      worse = -change if higher_is_better else change
+      noise = max(old_results[key].get("noise", {}).get(metric, 0), result.get("noise", {}).get(metric, 0))
+      if worse > max(threshold, noise):
+        regressions.append((key, metric, old_value, new_value, change))
+  return regressions
+
+
+# Time Disease_Model setup for each population size. Returns one result per
+# size, with the total setup time and the time per agent.
+def benchmark_startup(sizes=(100000, 300000, 1000000), density=1.0, seed=0):
+  results = []
+  for num_agents in sizes:
+    params = population_params(num_agents, density)
+    start = time.perf_counter()
+    model = Disease_Model(**params, seed=seed)
+    seconds = time.perf_counter() - start
+    results.append({"agents":num_agents, "width":params["width"], "height":params["height"],
+                    "seconds":seconds, "microseconds_per_agent":1e6 * seconds / num_agents})
+    del model
+  return results
+
+
+# Measure the memory used per agent: the memory allocated setting up a
+# model with num_agents agents, less that of a model with no agents on the
+# same grid, divided by the number of agents
+def benchmark_memory(sizes=(10000, 100000), seed=0):
+  results = []
+  for num_agents in sizes:
+    params = population_params(num_agents)
+    empty_params = dict(params, N=0, rodent_population=0)
+    allocated = []
+    for model_params in (empty_params, params):
+      tracemalloc.start()
+      model = Disease_Model(**model_params, seed=seed)
+      allocated.append(tracemalloc.get_traced_memory()[0])
+      tracemalloc.stop()
+      del model
+    results.append({"agents":num_agents, "bytes_per_agent":(allocated[1] - allocated[0]) / num_agents})
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the Lassa Fever model.")
+  commands = parser.add_subparsers(dest="benchmark", required=True)
+
+  run_parser = commands.add_parser("run", help="run the benchmark suite and save the results as JSON")
+  run_parser.add_argument("--humans", type=int, nargs="+", default=[1000, 5000])
+  run_parser.add_argument("--rodents", type=int, nargs="+", default=[1000, 5000])
+  run_parser.add_argument("--grid-sizes", type=int, nargs="+", default=[50, 100], help="grid widths (grids are square)")
+  run_parser.add_argument("--regimes", nargs="+", choices=list(REGIMES), default=list(REGIMES))
+  run_parser.add_argument("--steps", type=int, default=20)
+  run_parser.add_argument("--repeats", type=int, default=5, help="timed runs of each case, each in a new process (the median is kept)")
+  run_parser.add_argument("--out", default="benchmark.json")
+
+  compare_parser = commands.add_parser("compare", help="list regressions between two saved runs")
+  compare_parser.add_argument("old")
+  compare_parser.add_argument("new")
+  compare_parser.add_argument("--threshold", type=float, default=0.1, help="fractional change counted as a regression")
+
+  startup_parser = commands.add_parser("startup", help="time model setup for large populations")
+  startup_parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 300000, 1000000], help="numbers of agents")
+  startup_parser.add_argument("--density", type=float, default=1.0, help="agents per grid cell")
+
+  memory_parser = commands.add_parser("memory", help="measure memory per agent")
+  memory_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="numbers of agents")
+  args = parser.parse_args()
+
+  if args.benchmark == "run":
+    suite = run_suite(args.humans, args.rodents, args.grid_sizes, args.regimes, args.steps, repeats=args.repeats)
+    with open(args.out, "w") as f:
+      json.dump(suite, f, indent=2)
+  elif args.benchmark == "compare":
+    with open(args.old) as f:
+      old = json.load(f)
+    with open(args.new) as f:
+      new = json.load(f)
+    regressions = compare_results(old, new, args.threshold)
+    for (humans, rodents, grid_size, regime, steps), metric, old_value, new_value, change in regressions:
+      print("{} humans, {} rodents, {}x{}, {}: {} {:.4g} -> {:.4g} ({:+.0%})".format(
+        humans, rodents, grid_size, grid_size, regime, metric, old_value, new_value, change))
+    noisy = sum(1 for result in old["results"] + new["results"]
+                for noise in result.get("noise", {}).values() if noise > args.threshold)
+    if noisy:
+      print("{} measurements were noisier than {:.0%}; changes in them were only counted beyond their noise".format(noisy, args.threshold))
+    if regressions:
+      sys.exit(1)
+    print("No regressions beyond {:.0%}".format(args.threshold))
+  elif args.benchmark == "startup":
+    for result in benchmark_startup(args.sizes, args.density):
+      print("{agents:>9} agents on {width}x{height}: {seconds:.2f}s ({microseconds_per_agent:.1f} us/agent)".format(**result))
+  else:
+    for result in benchmark_memory(args.sizes):
+      print("{agents:>9} agents: {bytes_per_agent:.0f} bytes/agent".format(**result))
+
+
+if __name__ == "__main__":
+  main()
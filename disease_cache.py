@@ -0,0 +1,272 @@
+# An on-disk cache of finished Disease_Model runs, so a run that has been done
+# before (the same parameters, seed and number of steps, with the same model
+# code) is read back rather than run again. Each run's results are stored in
+# a file named after a hash of everything that decides them:
+#
+#   <path>/<hash>.parquet   (or .csv)
+#
+# The cache is kept under a size limit by deleting the least recently used
+# runs (reading a run counts as using it) whenever the running total of its
+# size, kept in <path>/size, passes the limit. Any number of processes can share
+# a cache directory: files are written whole and renamed into place, so a
+# reader only ever sees finished files, and a run deleted while it's being
+# looked up is just a miss.
+#
+# Runs without a seed are never cached, as running them again is meant to
+# give a different result.
+#
+# Example - use a cache for a sweep:
+#   python3 disease_sweep.py --param pesticide=0,10,20 --replicas 10 --cache result_cache
+#
+# or from Python, with run_model from disease_sweep.py:
+#   cache = Result_Cache("result_cache")
+#   results = run_model(params, seed=1, steps=200, cache=cache)
+import argparse
+import ast
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
+import os
+import time
+
+import mesa
+import numpy as np
+import pandas as pd
+
+from disease_collector import default_format, read_table, write_table
+from disease_model import Disease_Model
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# Bump to throw away every cached run, e.g. when what's stored for a run
+# changes
+CACHE_VERSION = 1
+
+# Source files whose code decides the results of a run, or what's stored
+# for it (run_model in disease_sweep.py builds the table that's cached).
+# Every disease_* module these import is included too (see model_sources).
+MODEL_SOURCES = ("disease_model.py", "disease_sweep.py")
+
+# File locked by a process updating the cache's size or removing old runs,
+# so only one does at a time
+LOCK_NAME = "evict.lock"
+
+# File holding the total size of the cached runs in bytes, kept up to date
+# as runs are added, so the whole cache only has to be looked through when
+# it passes the size limit
+SIZE_NAME = "size"
+
+# Temporary files older than this (in seconds) were left by a writer that
+# crashed, and are removed along with old runs
+STALE_TEMP_AGE = 3600
+
+
+# MODEL_SOURCES along with every disease_* module they import at the top
+# level, directly or through each other (e.g. disease_collector.py, which
+# writes the stored files, and disease_profile.py), in sorted order
+def model_sources():
+  here = os.path.dirname(os.path.abspath(__file__))
+  sources = set()
+  to_read = list(MODEL_SOURCES)
+  while to_read:
+    name = to_read.pop()
+    if name in sources:
+      continue
+    sources.add(name)
+    with open(os.path.join(here, name)) as f:
+      tree = ast.parse(f.read(), name)
+    for node in tree.body:
+      if isinstance(node, ast.Import):
+        modules = [alias.name for alias in node.names]
+      elif isinstance(node, ast.ImportFrom) and node.level == 0:
+        modules = [node.module]
+      else:
+        continue
+      to_read.extend(module + ".py" for module in modules if module.startswith("disease_"))
+  return sorted(sources)
+
+
+# A hash of the model's code (and the versions of the libraries it draws
+# its random numbers with), so runs cached before the model was changed
+# aren't mistaken for runs of the new model
+@functools.lru_cache(maxsize=None)
+def code_version():
+  digest = hashlib.sha256()
+  digest.update("{} {} {}".format(CACHE_VERSION, mesa.__version__, np.__version__).encode())
+  here = os.path.dirname(os.path.abspath(__file__))
+  for name in model_sources():
+    digest.update(name.encode())
+    with open(os.path.join(here, name), "rb") as f:
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+# The hash a run is stored under. Parameters not given are filled in with
+# Disease_Model's defaults, so leaving one out and giving its default value
+# are the same run.
+def run_key(params, seed, steps):
+  bound = inspect.signature(Disease_Model).bind_partial(**params)
+  bound.apply_defaults()
+  # NumPy numbers (e.g. from a sweep's ranges) are hashed as the plain
+  # Python numbers they equal
+  params = {name:value.item() if isinstance(value, np.generic) else value
+            for name, value in bound.arguments.items() if name != "seed"}
+  description = json.dumps({"params":params, "seed":seed, "steps":steps, "code":code_version()}, sort_keys=True)
+  return hashlib.sha256(description.encode()).hexdigest()
+
+
+class Result_Cache:
+  # max_bytes is the most disk space the cached runs can take up (1 GB by
+  # default)
+  def __init__(self, path="result_cache", max_bytes=1 << 30, file_format=None):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.file_format = file_format or default_format()
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(path, exist_ok=True)
+
+  def entry_path(self, key):
+    return os.path.join(self.path, "{}.{}".format(key, self.file_format))
+
+  # The stored results of a run, or None if it isn't in the cache (or has
+  # no seed)
+  def get(self, params, seed, steps):
+    if seed is None:
+      return None
+    path = self.entry_path(run_key(params, seed, steps))
+    try:
+      results = read_table(path)
+      os.utime(path) # mark it as recently used
+    except FileNotFoundError:
+      self.misses += 1
+      return None
+    self.hits += 1
+    # A column of None (e.g. the stop reason of a run that didn't stop
+    # early) is written as empty values, and read back as NaN
+    for name in results.columns[results.isna().all()]:
+      results[name] = pd.Series([None] * len(results), index=results.index, dtype=object)
+    return results
+
+  # Store the results of a run (a DataFrame), then make room if the cache
+  # has grown past its limit. Runs without a seed aren't stored, and nor
+  # are runs already in the cache (e.g. stored by another process since
+  # get was called).
+  def put(self, params, seed, steps, results):
+    if seed is None:
+      return
+    path = self.entry_path(run_key(params, seed, steps))
+    try:
+      os.utime(path) # already stored, so just mark it as recently used
+      return
+    except FileNotFoundError:
+      pass
+    write_table(results, path)
+    try:
+      added = os.path.getsize(path)
+    except FileNotFoundError:
+      return # already removed by another process making room
+    with self.locked():
+      total = self.read_size()
+      if total is None or total + added > self.max_bytes:
+        self.remove_oldest()
+      else:
+        self.write_size(total + added)
+
+  # Hold the cache's lock. Processes take turns, so each sees the cache
+  # only after the one before has finished with it (and every run written
+  # before it started waiting).
+  @contextlib.contextmanager
+  def locked(self):
+    with open(os.path.join(self.path, LOCK_NAME), "a") as lock:
+      if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+      yield
+
+  # The total size of the cached runs as last recorded, or None if it
+  # hasn't been (or the file is unreadable). Call with the lock held.
+  def read_size(self):
+    try:
+      with open(os.path.join(self.path, SIZE_NAME)) as f:
+        return int(f.read())
+    except (FileNotFoundError, ValueError):
+      return None
+
+  def write_size(self, total):
+    with open(os.path.join(self.path, SIZE_NAME), "w") as f:
+      f.write(str(total))
+
+  # The cached runs, as (last used, size, path), oldest first. Temporary
+  # files that have been left behind by a crashed writer are removed.
+  def entries(self):
+    entries = []
+    now = time.time()
+    for entry in os.scandir(self.path):
+      try:
+        stat = entry.stat()
+        if entry.name.endswith(".tmp"):
+          if now - stat.st_mtime > STALE_TEMP_AGE:
+            os.remove(entry.path)
+        elif entry.name not in (LOCK_NAME, SIZE_NAME):
+          entries.append((stat.st_mtime, stat.st_size, entry.path))
+      except FileNotFoundError:
+        pass # removed by another process in the meantime
+    return sorted(entries)
+
+  # Total size in bytes of the cached runs
+  def size(self):
+    return sum(size for last_used, size, path in self.entries())
+
+  # Remove the least recently used runs until the rest fit within
+  # max_bytes. put does this whenever the cache grows past the limit.
+  def evict(self):
+    with self.locked():
+      self.remove_oldest()
+
+  # Look through the whole cache, removing the least recently used runs
+  # until the rest fit within max_bytes, and record the size that's left.
+  # Call with the lock held.
+  def remove_oldest(self):
+    entries = self.entries()
+    total = sum(size for last_used, size, path in entries)
+    for last_used, size, path in entries:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+    self.write_size(total)
+
+  # Remove every cached run
+  def clear(self):
+    with self.locked():
+      for last_used, size, path in self.entries():
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+      self.write_size(0)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Show or clear a cache of Lassa Fever model runs.")
+  parser.add_argument("path", nargs="?", default="result_cache", help="cache directory")
+  parser.add_argument("--clear", action="store_true", help="remove every cached run")
+  args = parser.parse_args()
+
+  cache = Result_Cache(args.path)
+  if args.clear:
+    cache.clear()
+  entries = cache.entries()
+  print("{} runs, {:.1f} MB".format(len(entries), sum(size for last_used, size, path in entries) / 1e6))
+
+
+if __name__ == "__main__":
+  main()
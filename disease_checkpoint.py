@@ -0,0 +1,208 @@
+import io
+import json
+import os
+import sys
+
+import numpy as np
+
+from disease_collector import Streaming_DataCollector
+from disease_model import Disease_Model
+
+# Save the whole state of a Disease_Model part way through a run to a
+# compact binary file, and restore it later to carry on from where it left
+# off - e.g. run the burn-in once, checkpoint it, and then try several
+# interventions from the same starting point:
+#
+#   save_checkpoint(model, "day100.npz")
+#   with_pesticide = load_checkpoint("day100.npz", pesticide=20)
+#   with_treatment = load_checkpoint("day100.npz", treatment_chance=60)
+#
+# or, without going through a file, fork_model(model, pesticide=20).
+#
+# A checkpoint holds every agent (its position, compartment and countdowns,
+# in schedule order), the running tallies, the state of the model's random
+# number streams, the termination criteria and the data collected so far.
+# A restored model given no changes carries on exactly as the original would
+# have. Any of Disease_Model's parameters can be changed when restoring,
+# apart from the population and grid size; changing the seed starts new
+# random number streams from it rather than carrying on the saved ones.
+
+CHECKPOINT_FORMAT = 1
+
+# Parameters that fix the agents and grid a checkpoint holds
+FIXED_PARAMS = ("N", "rodent_population", "width", "height")
+
+# Random number streams belonging to the model
+RANDOM_STREAMS = ("setup_random", "human_random", "rodent_random", "random")
+
+
+# The parameters a model was created with (or would be created with to give
+# its current settings)
+def model_params(model):
+  human_params = model.human_params
+  rodent_params = model.rodent_params
+  termination = model.termination
+  return {"N":model.num_humans, "width":model.grid.width, "height":model.grid.height,
+          "initial_infection":rodent_params.initial_infection,
+          "transmissibility":rodent_params.transmissibility,
+          "level_of_movement":rodent_params.level_of_movement,
+          "mean_length_of_disease":rodent_params.mean_length_of_disease,
+          "rodent_population":model.num_rodents,
+          "treatment_chance":human_params.treatment_chance,
+          "treatment_length":human_params.treatment_length,
+          "isolation":human_params.isolation,
+          "environmental":rodent_params.environmental,
+          "pesticide":rodent_params.pesticide,
+          "seed":model.seed, "prune_dead":model.prune_dead,
+          "stop_on_extinction":termination.stop_on_extinction,
+          "stable_steps":termination.stable_steps, "max_steps":termination.max_steps,
+          "debug":model.debug, "profile":model.profile}
+
+
+# Write a checkpoint of model to file, which can be a path or a file object
+def save_checkpoint(model, file):
+  if isinstance(model.datacollector, Streaming_DataCollector):
+    raise ValueError("Can't checkpoint a model whose data is being streamed to disk")
+
+  agents = model.schedule.agents
+  count = len(agents)
+  arrays = {"unique_id":np.fromiter((agent.unique_id for agent in agents), dtype=np.int64, count=count),
+            "is_human":np.fromiter((agent.is_human for agent in agents), dtype=bool, count=count),
+            "x":np.fromiter((agent.pos[0] for agent in agents), dtype=np.int64, count=count),
+            "y":np.fromiter((agent.pos[1] for agent in agents), dtype=np.int64, count=count),
+            "state":np.fromiter((agent.state for agent in agents), dtype=np.int8, count=count),
+            "disease_duration":np.fromiter((getattr(agent, "disease_duration", 0) for agent in agents), dtype=np.int64, count=count),
+            "treat_length":np.fromiter((getattr(agent, "treat_length", 0) for agent in agents), dtype=np.int64, count=count)}
+
+  random_states = {}
+  for name in RANDOM_STREAMS:
+    state = getattr(model, name).get_state()
+    arrays["block/" + name] = np.array(state["block"], dtype=np.float64)
+    random_states[name] = state["generator"]
+
+  datacollector = model.datacollector
+  for i, values in enumerate(datacollector.model_vars.values()):
+    arrays["model_vars/{}".format(i)] = np.array(values)
+
+  termination = model.termination
+  meta = {"format":CHECKPOINT_FORMAT,
+          "params":model_params(model),
+          "steps":model.schedule.steps, "time":model.schedule.time,
+          "running":model.running, "stop_reason":model.stop_reason, "stop_step":model.stop_step,
+          "tallies":[model.total_infected, model.total_susceptible, model.total_deceased,
+                     model.total_exposed, model.total_removed],
+          "num_pruned":model.num_pruned,
+          "termination":{"last_counts":termination.last_counts, "unchanged_steps":termination.unchanged_steps},
+          "random":random_states,
+          "model_vars":list(datacollector.model_vars),
+          "tables":datacollector.tables}
+  arrays["meta"] = np.array(json.dumps(meta))
+
+  if isinstance(file, str):
+    # Write to a temporary file and rename it into place, so a crash part way
+    # through never leaves a file that looks finished
+    temp_path = file + ".tmp"
+    with open(temp_path, "wb") as f:
+      np.savez_compressed(f, **arrays)
+    os.replace(temp_path, file)
+  else:
+    np.savez_compressed(file, **arrays)
+
+
+# Restore a model from a checkpoint written by save_checkpoint. Keyword
+# arguments change any of the model's parameters (other than the population
+# and grid size) from what they were when it was saved.
+def load_checkpoint(file, **changes):
+  with np.load(file) as checkpoint:
+    arrays = {name:checkpoint[name] for name in checkpoint.files}
+  meta = json.loads(str(arrays["meta"]))
+  if meta["format"] != CHECKPOINT_FORMAT:
+    raise ValueError("Unsupported checkpoint format {}".format(meta["format"]))
+
+  params = meta["params"]
+  fixed = [name for name in FIXED_PARAMS if name in changes and changes[name] != params[name]]
+  if fixed:
+    raise ValueError("Can't change {} when restoring a checkpoint".format(", ".join(fixed)))
+  unknown = set(changes) - set(params)
+  if unknown:
+    raise ValueError("Unknown Disease_Model parameters: {}".format(", ".join(sorted(unknown))))
+  reseed = "seed" in changes and changes["seed"] != params["seed"]
+  params = dict(params, **changes)
+
+  # Set up a model with the same settings but no agents, then put the saved
+  # agents back into it
+  model = Disease_Model(**dict(params, N=0, rodent_population=0))
+  model.num_humans = params["N"]
+  model.num_rodents = params["rodent_population"]
+  human_class, rodent_class = model.agent_classes
+  for unique_id, is_human, x, y, state, disease_duration, treat_length in zip(
+      arrays["unique_id"].tolist(), arrays["is_human"].tolist(), arrays["x"].tolist(), arrays["y"].tolist(),
+      arrays["state"].tolist(), arrays["disease_duration"].tolist(), arrays["treat_length"].tolist()):
+    if is_human:
+      agent = human_class(unique_id, model, model.human_params)
+      agent.treat_length = treat_length
+    else:
+      agent = rodent_class(unique_id, model, model.rodent_params)
+    agent.state = state
+    agent.disease_duration = disease_duration
+    agent.indexed = agent.index_state()
+    model.schedule.add(agent)
+    model.grid.place_agent(agent, (x, y))
+
+  (model.total_infected, model.total_susceptible, model.total_deceased,
+   model.total_exposed, model.total_removed) = meta["tallies"]
+  model.num_pruned = meta["num_pruned"]
+  model.schedule.steps = meta["steps"]
+  model.schedule.time = meta["time"]
+  model.running = meta["running"]
+  model.stop_reason = meta["stop_reason"]
+  model.stop_step = meta["stop_step"]
+  last_counts = meta["termination"]["last_counts"]
+  model.termination.last_counts = None if last_counts is None else tuple(last_counts)
+  model.termination.unchanged_steps = meta["termination"]["unchanged_steps"]
+
+  # Carry on the saved random number streams, unless given a new seed (in
+  # which case the model's new streams are left as they are)
+  if not reseed:
+    for name in RANDOM_STREAMS:
+      getattr(model, name).set_state({"generator":meta["random"][name],
+                                      "block":arrays["block/" + name].tolist()})
+
+  datacollector = model.datacollector
+  for i, name in enumerate(meta["model_vars"]):
+    datacollector.model_vars[name] = arrays["model_vars/{}".format(i)].tolist()
+  for name, table in meta["tables"].items():
+    datacollector.tables[name] = table
+  return model
+
+
+# A copy of model, carrying on from its current state, with any parameters
+# changed as given (as for load_checkpoint)
+def fork_model(model, **changes):
+  buffer = io.BytesIO()
+  save_checkpoint(model, buffer)
+  buffer.seek(0)
+  return load_checkpoint(buffer, **changes)
+
+
+# Check that a model restored from a checkpoint carries on exactly as the
+# original does: run burn_in steps, fork, then run both for steps more and
+# compare the data they collect. Run this file to check it, exiting with
+# status 1 if they differ.
+def check_checkpoint(burn_in=30, steps=30, seed=0, **params):
+  from disease_sweep import slider_defaults
+  params = dict(slider_defaults(), **params)
+  model = Disease_Model(**params, seed=seed)
+  for i in range(burn_in):
+    model.step()
+  restored = fork_model(model)
+  for i in range(steps):
+    model.step()
+    restored.step()
+  return model.datacollector.get_model_vars_dataframe().equals(restored.datacollector.get_model_vars_dataframe())
+
+
+if __name__ == "__main__":
+  same = check_checkpoint()
+  print("OK" if same else "DIFFERENT")
+  sys.exit(0 if same else 1)
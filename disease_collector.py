@@ -0,0 +1,152 @@
+import os
+import threading
+
+import pandas as pd
+from mesa.datacollection import DataCollector
+
+# A datacollector for long runs that doesn't keep every step's results in
+# memory. Model reporter values, and rows added to tables (e.g. the model's
+# "Termination" and "Profile" tables), are buffered for a fixed number of
+# steps and then written out as a chunk to an append-only set of part files:
+#
+#   <path>/model_vars/part-000000.parquet   (or .csv)
+#   <path>/model_vars/part-000001.parquet
+#   ...
+#   <path>/agents/part-000000.parquet       (optional agent snapshots)
+#   <path>/<table name>/part-000000.parquet
+#
+# Each part is written whole and renamed into place, so the files on disk can
+# be read at any time (even while the run is still going, or after it has
+# crashed), and read back one part at a time with iter_parts.
+
+
+# Parquet is used if pyarrow is installed, otherwise CSV
+def default_format():
+  try:
+    import pyarrow
+  except ImportError:
+    return "csv"
+  return "parquet"
+
+
+def write_table(table, path):
+  # Write to a temporary file and rename it into place, so a crash part way
+  # through writing never leaves a file that looks finished. The temporary
+  # file is named after the process and thread writing it, so two writing
+  # the same file at once don't write over each other's.
+  temp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+  if path.endswith(".parquet"):
+    table.to_parquet(temp_path, index=False)
+  else:
+    table.to_csv(temp_path, index=False)
+  os.replace(temp_path, path)
+
+
+def read_table(path):
+  if path.endswith(".parquet"):
+    return pd.read_parquet(path)
+  return pd.read_csv(path)
+
+
+# Read the part files of one table ("model_vars", "agents" or the name of
+# one of its tables) written by a Streaming_DataCollector, one part at a
+# time and in the order written
+def iter_parts(path, table="model_vars"):
+  table_dir = os.path.join(path, table)
+  if not os.path.isdir(table_dir):
+    return
+  for name in sorted(os.listdir(table_dir)):
+    if name.startswith("part-") and not name.endswith(".tmp"):
+      yield read_table(os.path.join(table_dir, name))
+
+
+# Read a whole table written by a Streaming_DataCollector into one DataFrame
+def read_parts(path, table="model_vars"):
+  parts = list(iter_parts(path, table))
+  if not parts:
+    return pd.DataFrame()
+  return pd.concat(parts, ignore_index=True)
+
+
+class Streaming_DataCollector(DataCollector):
+  # path: directory to write the part files to
+  # buffer_steps: number of steps of model reporter values (and table rows)
+  #   to hold in memory before writing them out
+  # agent_snapshot_every: if given, record the state of every agent (from
+  #   the model's agent_snapshot()) every this many steps. Each snapshot is
+  #   written out straight away.
+  def __init__(self, path, model_reporters=None, tables=None, buffer_steps=1000, agent_snapshot_every=None, file_format=None):
+    super().__init__(model_reporters=model_reporters, tables=tables)
+    self.path = path
+    self.buffer_steps = buffer_steps
+    self.agent_snapshot_every = agent_snapshot_every
+    self.file_format = file_format or default_format()
+    self.steps = 0 # number of times collect has been called
+    self.buffered_steps = [] # step numbers of the values currently buffered
+    self.num_parts = dict.fromkeys(["model_vars", "agents"] + list(self.tables), 0)
+    for table in self.num_parts:
+      os.makedirs(os.path.join(path, table), exist_ok=True)
+      if any(True for part in iter_parts(path, table)):
+        raise ValueError("{} already holds collected data; use a new directory for each run".format(path))
+
+  def collect(self, model):
+    super().collect(model)
+    self.steps += 1
+    self.buffered_steps.append(self.steps)
+    if len(self.buffered_steps) >= self.buffer_steps:
+      self.flush()
+
+    if self.agent_snapshot_every and self.steps % self.agent_snapshot_every == 0:
+      snapshot = pd.DataFrame(model.agent_snapshot())
+      snapshot.insert(0, "Step", self.steps)
+      self.write_part("agents", snapshot)
+
+  def write_part(self, table, frame):
+    name = "part-{:06d}.{}".format(self.num_parts[table], self.file_format)
+    write_table(frame, os.path.join(self.path, table, name))
+    self.num_parts[table] += 1
+
+  # The buffered model reporter values as a DataFrame
+  def buffered_model_vars(self):
+    frame = pd.DataFrame(self.model_vars)
+    frame.insert(0, "Step", self.buffered_steps)
+    return frame
+
+  # Write out any buffered model reporter values and table rows
+  def flush(self):
+    if self.buffered_steps:
+      self.write_part("model_vars", self.buffered_model_vars())
+      for values in self.model_vars.values():
+        values.clear()
+      self.buffered_steps = []
+    for name, table in self.tables.items():
+      if any(table.values()):
+        self.write_part(name, pd.DataFrame(table))
+        for values in table.values():
+          values.clear()
+
+  # Everything collected so far - both what's been written out and what's
+  # still buffered - in the same layout as DataCollector's. This reads the
+  # whole run into memory, so for long runs use iter_parts instead.
+  def get_model_vars_dataframe(self):
+    parts = list(iter_parts(self.path, "model_vars"))
+    if self.buffered_steps:
+      parts.append(self.buffered_model_vars())
+    if not parts:
+      return pd.DataFrame(columns=list(self.model_vars))
+    return pd.concat(parts, ignore_index=True).drop(columns="Step")
+
+  def get_agent_vars_dataframe(self):
+    return read_parts(self.path, "agents")
+
+  # A whole table - the rows written out and those still buffered - as
+  # DataCollector's does
+  def get_table_dataframe(self, table_name):
+    if table_name not in self.tables:
+      raise Exception("No such table.")
+    parts = list(iter_parts(self.path, table_name))
+    if any(self.tables[table_name].values()):
+      parts.append(pd.DataFrame(self.tables[table_name]))
+    if not parts:
+      return pd.DataFrame(columns=list(self.tables[table_name]))
+    return pd.concat(parts, ignore_index=True)
@@ -0,0 +1,51 @@
+import numpy as np
+
+# Statistical equivalence checks between two versions of the model that take
+# the same parameters and report the same five series (e.g.
+# Vectorized_Disease_Model against Disease_Model). Used by the checks run
+# with `python3 disease_vectorized.py` and `python3 disease_sharded.py`.
+
+SERIES = ["Infected Humans", "Susceptible Humans", "Deceased Rodents",
+          "Exposed Humans", "Removed/Recovered/Isolated Humans"]
+
+
+# Run a number of replicas of both models with the same parameters and
+# compare the mean trajectory of each of the five series. make_reference
+# and make_candidate are called with the model parameters and a seed to
+# create each replica (a model class will do); models with a close method
+# are closed once they've run. For each series we return the largest gap
+# between the two mean curves over all ticks, and the tolerance it's
+# checked against: `tolerance` times the number of humans (or rodents, for
+# Deceased Rodents), plus three standard errors of the difference in means
+# at that tick to allow for replica noise.
+def compare_models(make_reference, make_candidate, params, replicas=50, steps=100, tolerance=0.01, seed=0):
+  def run(model):
+    for i in range(steps):
+      model.step()
+    if hasattr(model, "close"):
+      model.close()
+    return model.datacollector.get_model_vars_dataframe().to_numpy(dtype=float)
+
+  reference_runs = np.stack([run(make_reference(**params, seed=seed + i)) for i in range(replicas)])
+  candidate_runs = np.stack([run(make_candidate(**params, seed=seed + i)) for i in range(replicas)])
+
+  population = np.array([params["N"], params["N"], params["rodent_population"], params["N"], params["N"]])
+  gap = np.abs(reference_runs.mean(axis=0) - candidate_runs.mean(axis=0))
+  standard_error = np.sqrt((reference_runs.var(axis=0, ddof=1) + candidate_runs.var(axis=0, ddof=1)) / replicas)
+  allowed = tolerance * population + 3 * standard_error
+
+  results = {}
+  for i, name in enumerate(SERIES):
+    worst = int(np.argmax(gap[:, i] - allowed[:, i]))
+    results[name] = {"max_gap":float(gap[worst, i]), "allowed":float(allowed[worst, i]),
+                     "equivalent":bool(gap[worst, i] <= allowed[worst, i])}
+  return results
+
+
+# Print the results of compare_models, one line per series. Returns the
+# exit status for a check script: 0 if every series matched, 1 if not.
+def report_comparison(results):
+  for name, result in results.items():
+    print("{}: max gap {:.2f} (allowed {:.2f}) {}".format(
+      name, result["max_gap"], result["allowed"], "OK" if result["equivalent"] else "DIFFERENT"))
+  return 0 if all(result["equivalent"] for result in results.values()) else 1
@@ -0,0 +1,226 @@
+# Ensembles of Disease_Model replicas, summarised as they run. Rather than
+# keeping every replica's trajectory and working out mean curves and bands
+# afterwards, each replica's results are folded into running statistics as
+# soon as it finishes and then thrown away: for each step and compartment,
+# the mean and variance (Welford's method) and a histogram sketch that the
+# quantiles are read from.
+#
+# Replicas are added until the confidence intervals on the outputs we care
+# about (by default the peak number of infected humans and the final number
+# of removed humans) are narrower than a target width, so easy parameter sets
+# stop after a few replicas and noisy ones get as many as they need.
+#
+# Example - 95% confidence intervals within 5% of the mean:
+#   python3 disease_ensemble.py --param pesticide=10 --steps 200 --target-width 0.05 --out ensemble.csv
+import argparse
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from disease_model import Disease_Model
+
+# The compartments reported by Disease_Model, in the order of its datacollector
+COMPARTMENTS = ["Infected Humans", "Susceptible Humans", "Deceased Rodents", "Exposed Humans",
+                "Removed/Recovered/Isolated Humans"]
+
+# Outputs the stopping rule can be based on: name -> function of a replica's
+# trajectory (an array of shape (steps, compartments))
+OUTPUTS = {"Peak Infected Humans":lambda trajectory: trajectory[:, 0].max(),
+           "Final Removed Humans":lambda trajectory: trajectory[-1, 4]}
+
+
+# Running mean and variance of a series of equally shaped arrays (Welford's
+# method), without keeping the arrays
+class Running_Stats:
+  def __init__(self, shape=()):
+    self.count = 0
+    self.mean = np.zeros(shape)
+    self.m2 = np.zeros(shape) # sum of squared differences from the mean
+
+  def add(self, values):
+    self.count += 1
+    delta = values - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (values - self.mean)
+
+  @property
+  def variance(self):
+    if self.count < 2:
+      return np.zeros_like(self.m2)
+    return self.m2 / (self.count - 1)
+
+  # Width of the confidence interval on the mean (normal approximation)
+  def interval_width(self, confidence=0.95):
+    if self.count < 2:
+      return np.full_like(self.m2, math.inf)
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    return 2 * z * np.sqrt(self.variance / self.count)
+
+
+# Histograms of a series of equally shaped arrays of counts, for reading off
+# quantiles. The values in the last dimension i range from 0 to upper[i], and
+# are put into a fixed number of equal bins, so quantiles are accurate to
+# within one bin width (upper / bins) however many arrays are added.
+class Histogram_Sketch:
+  def __init__(self, shape, upper, bins=256):
+    self.count = 0
+    self.bins = bins
+    self.width = np.maximum(1, np.ceil((np.asarray(upper) + 1) / bins)) * np.ones(shape)
+    self.counts = np.zeros(tuple(shape) + (bins,), dtype=np.int64)
+
+  def add(self, values):
+    self.count += 1
+    bins = np.minimum(values // self.width, self.bins - 1).astype(np.int64).ravel()
+    self.counts.reshape(-1, self.bins)[np.arange(bins.size), bins] += 1
+
+  # Estimate of the q quantile of each value, interpolating within its bin
+  def quantile(self, q):
+    cumulative = np.cumsum(self.counts, axis=-1)
+    target = q * self.count
+    bins = np.argmax(cumulative >= target, axis=-1)[..., None]
+    in_bin = np.take_along_axis(self.counts, bins, axis=-1)[..., 0]
+    before = np.take_along_axis(cumulative, bins, axis=-1)[..., 0] - in_bin
+    fraction = np.where(in_bin > 0, (target - before) / np.maximum(in_bin, 1), 0)
+    return (bins[..., 0] + fraction) * self.width
+
+
+# Run a single replica and return its trajectory, an array of shape (steps,
+# compartments). If the model stops itself early, its final values are
+# carried forward to the end (once it's stopped, nothing changes). This is
+# what the worker processes run.
+def run_replica(params, seed, steps):
+  model = Disease_Model(**params, seed=seed)
+  while model.running and model.schedule.steps < steps:
+    model.step()
+  trajectory = np.array([model.datacollector.model_vars[name] for name in COMPARTMENTS], dtype=np.float64).T
+  if len(trajectory) < steps:
+    trajectory = np.concatenate([trajectory, np.repeat(trajectory[-1:], steps - len(trajectory), axis=0)])
+  return trajectory
+
+
+# The running statistics of an ensemble
+class Ensemble_Statistics:
+  def __init__(self, params, steps, outputs, quantiles, confidence, bins=256):
+    self.params = params
+    self.steps = steps
+    self.quantiles = quantiles
+    self.confidence = confidence
+    self.outputs = {name:OUTPUTS[name] for name in outputs}
+    self.trajectory = Running_Stats((steps, len(COMPARTMENTS)))
+    # Humans' compartments can hold up to every human, and deceased rodents
+    # up to every rodent
+    upper = [params["rodent_population"] if name == "Deceased Rodents" else params["N"] for name in COMPARTMENTS]
+    self.sketch = Histogram_Sketch((steps, len(COMPARTMENTS)), upper, bins)
+    self.output_stats = {name:Running_Stats() for name in self.outputs}
+
+  @property
+  def replicas(self):
+    return self.trajectory.count
+
+  def add(self, trajectory):
+    self.trajectory.add(trajectory)
+    self.sketch.add(trajectory)
+    for name, output in self.outputs.items():
+      self.output_stats[name].add(output(trajectory))
+
+  # Whether the confidence interval on every output is narrower than
+  # target_width times its mean
+  def converged(self, target_width):
+    return all(stats.interval_width(self.confidence) <= target_width * abs(stats.mean)
+               for stats in self.output_stats.values())
+
+  # Mean, standard deviation and quantiles of every compartment at every
+  # step, as a tidy table with one row per step per compartment
+  def summary(self):
+    steps, compartments = np.meshgrid(np.arange(1, self.steps + 1), COMPARTMENTS, indexing="ij")
+    table = pd.DataFrame({"step":steps.ravel(), "compartment":compartments.ravel(),
+                          "mean":self.trajectory.mean.ravel(),
+                          "std":np.sqrt(self.trajectory.variance).ravel()})
+    for q in self.quantiles:
+      table["q{:g}".format(q)] = self.sketch.quantile(q).ravel()
+    return table
+
+  # Mean and confidence interval of each output
+  def output_summary(self):
+    rows = []
+    for name, stats in self.output_stats.items():
+      half_width = stats.interval_width(self.confidence) / 2
+      rows.append({"output":name, "mean":float(stats.mean), "lower":float(stats.mean - half_width),
+                   "upper":float(stats.mean + half_width), "replicas":stats.count})
+    return pd.DataFrame(rows)
+
+
+# Run replicas of Disease_Model with the given parameters (any not given
+# keep their slider defaults) until the confidence intervals on every one of
+# outputs are narrower than target_width times the output's mean, or
+# max_replicas have been run. Replicas run across a pool of worker
+# processes, but are added to the statistics in order, so the result only
+# depends on the seed - not on how many workers there are or which finishes
+# first. Returns the Ensemble_Statistics.
+def run_ensemble(params=None, steps=100, seed=0, target_width=0.1, outputs=tuple(OUTPUTS), confidence=0.95,
+                 quantiles=(0.05, 0.5, 0.95), min_replicas=10, max_replicas=1000, workers=None):
+  from disease_sweep import slider_defaults
+  params = dict(slider_defaults(), **(params or {}))
+  unknown = set(outputs) - set(OUTPUTS)
+  if unknown:
+    raise ValueError("Unknown outputs: {}".format(", ".join(sorted(unknown))))
+  statistics = Ensemble_Statistics(params, steps, outputs, quantiles, confidence)
+  seeds = np.random.SeedSequence(seed)
+
+  def done():
+    return statistics.replicas >= max_replicas or (statistics.replicas >= min_replicas and statistics.converged(target_width))
+
+  workers = workers or os.cpu_count()
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    pending = {}
+    finished = {} # replicas finished before those ahead of them
+    next_replica = 0
+    while not done():
+      # Keep every worker busy, without running further ahead than needed
+      while len(pending) + len(finished) < workers and next_replica < max_replicas:
+        replica_seed = int(seeds.spawn(1)[0].generate_state(1)[0])
+        pending[pool.submit(run_replica, params, replica_seed, steps)] = next_replica
+        next_replica += 1
+      completed, not_done = wait(pending, return_when=FIRST_COMPLETED)
+      for future in completed:
+        finished[pending.pop(future)] = future.result()
+      while statistics.replicas in finished and not done():
+        statistics.add(finished.pop(statistics.replicas))
+    for future in pending:
+      future.cancel()
+  return statistics
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run replicas of the Lassa Fever model until its results are known to a given precision.")
+  parser.add_argument("--param", action="append", default=[], metavar="NAME=VALUE",
+                      help="parameter to set, e.g. pesticide=10 (can be repeated)")
+  parser.add_argument("--steps", type=int, default=100, help="steps per run")
+  parser.add_argument("--seed", type=int, default=0, help="seed for the whole ensemble")
+  parser.add_argument("--target-width", type=float, default=0.1,
+                      help="stop once every confidence interval is narrower than this fraction of its mean")
+  parser.add_argument("--outputs", nargs="+", choices=list(OUTPUTS), default=list(OUTPUTS))
+  parser.add_argument("--min-replicas", type=int, default=10)
+  parser.add_argument("--max-replicas", type=int, default=1000)
+  parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+  parser.add_argument("--out", default="ensemble.csv", help="file for the per-step summary")
+  args = parser.parse_args()
+
+  from disease_sweep import parse_values
+  params = {}
+  for param in args.param:
+    name, value = param.split("=", 1)
+    params[name] = parse_values(value)[0]
+
+  statistics = run_ensemble(params, args.steps, args.seed, args.target_width, args.outputs,
+                            min_replicas=args.min_replicas, max_replicas=args.max_replicas, workers=args.workers)
+  statistics.summary().to_csv(args.out, index=False)
+  print(statistics.output_summary().to_string(index=False))
+
+
+if __name__ == "__main__":
+  main()
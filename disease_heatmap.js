@@ -0,0 +1,84 @@
+// Browser side of Compartment_Heatmap (disease_heatmap.py). Keeps the count
+// of agents in each compartment in each cell, updated from the full counts
+// or the changes the server sends each frame, and draws the compartment
+// picked in the drop-down list as a heatmap.
+var HeatmapModule = function(grid_width, grid_height, canvas_width, canvas_height, layers) {
+    var num_cells = grid_width * grid_height;
+
+    // Drop-down list of compartments to draw
+    var select = $("<select style='display:block; margin-bottom:4px'></select>")[0];
+    layers.forEach(function(layer, i) {
+        $(select).append($("<option></option>").attr("value", i).text(layer.Label));
+    });
+    $("#elements").append(select);
+
+    var canvas_tag = "<canvas width='" + canvas_width + "' height='" + canvas_height + "' ";
+    canvas_tag += "style='border:1px dotted'></canvas>";
+    var canvas = $(canvas_tag)[0];
+    $("#elements").append(canvas);
+    var context = canvas.getContext("2d");
+
+    // The heatmap is drawn one pixel per cell on an offscreen canvas, then
+    // scaled up to the visible one
+    var cells_canvas = document.createElement("canvas");
+    cells_canvas.width = grid_width;
+    cells_canvas.height = grid_height;
+    var cells_context = cells_canvas.getContext("2d");
+    var image = cells_context.createImageData(grid_width, grid_height);
+
+    // Counts for every compartment and cell, compartment by compartment, with
+    // cells numbered x * grid_height + y
+    var counts = new Int32Array(layers.length * num_cells);
+
+    // RGB of each compartment's colour
+    var colors = layers.map(function(layer) {
+        var probe = document.createElement("canvas").getContext("2d");
+        probe.fillStyle = layer.Color;
+        probe.fillRect(0, 0, 1, 1);
+        return probe.getImageData(0, 0, 1, 1).data;
+    });
+
+    var draw = function() {
+        var layer = Number(select.value);
+        var offset = layer * num_cells;
+        var max = 1;
+        for (var i = 0; i < num_cells; i++) {
+            max = Math.max(max, counts[offset + i]);
+        }
+        var color = colors[layer];
+        var pixels = image.data;
+        for (var x = 0; x < grid_width; x++) {
+            for (var y = 0; y < grid_height; y++) {
+                // y = 0 is at the bottom, as in CanvasGrid
+                var p = 4 * ((grid_height - 1 - y) * grid_width + x);
+                var count = counts[offset + x * grid_height + y];
+                pixels[p] = color[0];
+                pixels[p + 1] = color[1];
+                pixels[p + 2] = color[2];
+                pixels[p + 3] = count == 0 ? 0 : Math.round(55 + 200 * count / max);
+            }
+        }
+        cells_context.putImageData(image, 0, 0);
+        context.clearRect(0, 0, canvas_width, canvas_height);
+        context.imageSmoothingEnabled = false;
+        context.drawImage(cells_canvas, 0, 0, canvas_width, canvas_height);
+    };
+
+    select.onchange = draw;
+
+    this.render = function(data) {
+        if (data.keyframe) {
+            counts.set(data.counts);
+        } else {
+            for (var i = 0; i < data.changed.length; i++) {
+                counts[data.changed[i]] = data.values[i];
+            }
+        }
+        draw();
+    };
+
+    this.reset = function() {
+        counts.fill(0);
+        draw();
+    };
+};
@@ -0,0 +1,77 @@
+import json
+
+import numpy as np
+from mesa.visualization.ModularVisualization import VisualizationElement
+
+from disease_model import INFECTED, SUSCEPTIBLE, EXPOSED, REMOVED, DEAD
+
+# Visualisation for large populations and grids. Rather than drawing every
+# agent (which means building and sending a portrayal for each one, every
+# frame), Compartment_Heatmap sends the number of agents in each compartment
+# in each cell, and the browser draws the compartment picked from a drop-down
+# list as a heatmap - one pixel block per cell, brighter the more agents
+# there are. After the first frame, only the counts that have changed are
+# sent.
+
+# The compartments counted in each cell: (name, is_human, compartment bit),
+# with the colour each is drawn in
+HEATMAP_LAYERS = [("Infected Humans", True, INFECTED, "red"),
+                  ("Susceptible Humans", True, SUSCEPTIBLE, "orange"),
+                  ("Exposed Humans", True, EXPOSED, "lime"),
+                  ("Removed/Recovered/Isolated Humans", True, REMOVED, "blue"),
+                  ("Infected Rodents", False, INFECTED, "red"),
+                  ("Susceptible Rodents", False, SUSCEPTIBLE, "orange"),
+                  ("Deceased Rodents", False, DEAD, "gray")]
+
+
+# Number of agents in each compartment of HEATMAP_LAYERS in each cell, as an
+# array of shape (layers, width * height) with cells numbered x * height + y
+def cell_counts(model):
+  agents = model.schedule.agents
+  height = model.grid.height
+  num_cells = model.grid.width * height
+  cells = np.fromiter((x * height + y for x, y in (agent.pos for agent in agents)), dtype=np.int64, count=len(agents))
+  states = np.fromiter((agent.state for agent in agents), dtype=np.int64, count=len(agents))
+  is_human = np.fromiter((agent.is_human for agent in agents), dtype=bool, count=len(agents))
+
+  counts = np.zeros((len(HEATMAP_LAYERS), num_cells), dtype=np.int64)
+  for i, (name, human, bit, color) in enumerate(HEATMAP_LAYERS):
+    in_layer = (states & bit != 0) & (is_human == human)
+    counts[i] = np.bincount(cells[in_layer], minlength=num_cells)
+  return counts
+
+
+class Compartment_Heatmap(VisualizationElement):
+  local_includes = ["disease_heatmap.js"]
+
+  def __init__(self, grid_width, grid_height, canvas_width=700, canvas_height=700):
+    self.grid_width = grid_width
+    self.grid_height = grid_height
+    self.canvas_width = canvas_width
+    self.canvas_height = canvas_height
+    layers = [{"Label":name, "Color":color} for name, human, bit, color in HEATMAP_LAYERS]
+    self.js_code = "elements.push(new HeatmapModule({}, {}, {}, {}, {}));".format(
+      grid_width, grid_height, canvas_width, canvas_height, json.dumps(layers))
+    # The model and counts last sent to the browser, which the next frame's
+    # changes are worked out against. (Like the rest of the server, this
+    # assumes one browser window is watching the model.)
+    self.last_model = None
+    self.last_counts = None
+
+  # Send the counts in full for the first frame of a model, and after that
+  # just the positions (in the flattened counts) and new values of those
+  # that have changed - or the counts in full if that would be smaller
+  def render(self, model):
+    counts = cell_counts(model).ravel()
+    if model is not self.last_model or self.last_counts is None:
+      changed = None
+    else:
+      changed = np.flatnonzero(counts != self.last_counts)
+      if 2 * len(changed) >= len(counts):
+        changed = None
+    self.last_model = model
+    self.last_counts = counts
+
+    if changed is None:
+      return {"keyframe":True, "counts":counts.tolist()}
+    return {"keyframe":False, "changed":changed.tolist(), "values":counts[changed].tolist()}
@@ -3,242 +3,363 @@ from mesa import Agent, Model
 from mesa.time import RandomActivation # random order of agent actions
 from mesa.space import MultiGrid # multiple agents per cell
 from mesa.datacollection import DataCollector
+import numpy as np
+from array import array
+from time import perf_counter
+
+from disease_collector import Streaming_DataCollector
+from disease_random import Random_Stream, spawn_seeds
+from disease_profile import PROFILE_COLUMNS, Step_Profiler
+
+# Offsets (dx, dy) of the 8 cells in a Moore neighbourhood, not including
+# the centre cell
+MOORE_DX = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+MOORE_DY = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+
+# Build the table of Moore neighbours for every cell of a toroidal grid. Cells
+# are numbered by flat index (x * height + y), and row i of the table holds
+# the flat indices of the 8 cells around cell i, wrapping around the edges.
+# (On a grid less than 3 cells wide or high some neighbours are the same cell
+# and appear more than once.)
+def moore_neighbour_table(width, height):
+  x, y = np.divmod(np.arange(width * height), height)
+  neighbour_x = (x[:, None] + MOORE_DX) % width
+  neighbour_y = (y[:, None] + MOORE_DY) % height
+  return neighbour_x * height + neighbour_y
+
+# A toroidal MultiGrid that also keeps an index of who is in each cell, so
+# that rodents infecting their cellmates don't have to look through everyone
+# in the cell. For each cell it keeps the set of humans there who can still
+# be exposed (not infected and not already exposed), and the number of
+# infected rodents there. An agent is in the index when its index_state() is
+# True; the index follows agents as they are moved, and the agents call
+# update_index whenever their state changes.
+class Disease_Grid(MultiGrid):
+  def __init__(self, width, height):
+    super().__init__(width, height, True)
+    self.exposable_humans = {} # cell -> set of humans that can be exposed
+    self.infected_rodents = {} # cell -> number of infected rodents
+    self.num_infected_rodents = 0 # across the whole grid
+
+  def add_to_index(self, pos, agent):
+    if agent.is_human:
+      self.exposable_humans.setdefault(pos, set()).add(agent)
+    else:
+      self.infected_rodents[pos] = self.infected_rodents.get(pos, 0) + 1
+      self.num_infected_rodents += 1
 
-import random
-
-# A class representing a 'human' agent. Note we're passing in the Agent class
+  def remove_from_index(self, pos, agent):
+    if agent.is_human:
+      self.exposable_humans[pos].discard(agent)
+    else:
+      self.infected_rodents[pos] -= 1
+      self.num_infected_rodents -= 1
+
+  def place_agent(self, agent, pos):
+    super().place_agent(agent, pos)
+    if agent.indexed:
+      self.add_to_index(agent.pos, agent)
+
+  def move_agent(self, agent, pos):
+    old_pos = agent.pos
+    super().move_agent(agent, pos)
+    if agent.indexed:
+      self.remove_from_index(old_pos, agent)
+      self.add_to_index(agent.pos, agent)
+
+  def remove_agent(self, agent):
+    if agent.indexed:
+      self.remove_from_index(agent.pos, agent)
+    super().remove_agent(agent)
+
+  # Add or remove an agent from the index after its state has changed
+  def update_index(self, agent):
+    indexed = agent.index_state()
+    if indexed != agent.indexed:
+      agent.indexed = indexed
+      if agent.pos is not None:
+        if indexed:
+          self.add_to_index(agent.pos, agent)
+        else:
+          self.remove_from_index(agent.pos, agent)
+
+# Compartment flags. Each agent's compartment is stored as a single small
+# integer made up of these bits, rather than as separate True/False
+# attributes. (More than one can be set at once - e.g. a removed human who
+# has since been exposed again.)
+INFECTED = 1
+SUSCEPTIBLE = 2
+EXPOSED = 4
+REMOVED = 8
+DEAD = 16
+
+# Parameters shared by every human. Each human points to the model's single
+# Human_Parameters object rather than keeping its own copy of every value.
+class Human_Parameters:
+  __slots__ = ("transmissibility", "level_of_movement", "mean_length_of_disease", "treatment_chance", "treatment_length", "isolation")
+
+  def __init__(self, transmissibility, level_of_movement, mean_length_of_disease, treatment_chance, treatment_length, isolation):
+    # the level of transmissiblity (the probability of becoming infected
+    # after being exposed)
+    self.transmissibility = transmissibility
+    # The probability that the agent will move from its current location
+    # at any given time step
+    self.level_of_movement = level_of_movement
+    # Average duration of being infected with the disease
+    self.mean_length_of_disease = mean_length_of_disease
+    # Chance (out of 100) of an exposed human being treated, and the
+    # duration of treatment
+    self.treatment_chance = treatment_chance
+    self.treatment_length = treatment_length
+    self.isolation = isolation
+
+# Parameters shared by every rodent (see Human_Parameters)
+class Rodent_Parameters:
+  __slots__ = ("initial_infection", "transmissibility", "level_of_movement", "mean_length_of_disease", "environmental", "pesticide")
+
+  def __init__(self, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, environmental, pesticide):
+    # Probability of a rodent being infected at the start
+    self.initial_infection = initial_infection
+    self.transmissibility = transmissibility
+    self.level_of_movement = level_of_movement
+    self.mean_length_of_disease = mean_length_of_disease
+    # Chance (out of 100) of a rodent not moving on a step (environmental
+    # control), and of dying (pesticide control)
+    self.environmental = environmental
+    self.pesticide = pesticide
+
+# A property that reads and writes one bit of an agent's compartment, so the
+# flags can still be used as True/False attributes (e.g. agent.infected) by
+# code such as agent_portrayal in disease_server.py
+def compartment_flag(bit):
+  def get_flag(agent):
+    return agent.state & bit != 0
+  def set_flag(agent, value):
+    agent.state = agent.state | bit if value else agent.state & ~bit
+  return property(get_flag, set_flag)
+
+# The parts common to humans and rodents. Note we're passing in the Agent class
 # we imported from the mesa library. Remember that this means our class here
 # is inheriting from the 'parent' Agent class, and our class is the 'child', 
 # which inherits all the attributes and methods of the parent, but may have some of its own.
-class Human_Agent(Agent):
+# __slots__ lists every attribute an agent has, so each agent is stored
+# compactly without a dictionary of attributes.
+class Disease_Agent(Agent):
+  __slots__ = ("unique_id", "model", "pos", "params", "state", "indexed", "disease_duration")
+
+  infected = compartment_flag(INFECTED)
+  susceptible = compartment_flag(SUSCEPTIBLE)
+  exposed = compartment_flag(EXPOSED)
+  removed = compartment_flag(REMOVED)
+  death = compartment_flag(DEAD)
+
+  # Snapshot of the flags counted by the model reporters: the bits of the
+  # compartment listed in the class's TALLIED. The model compares the
+  # snapshot from before and after a change to keep its running tallies up
+  # to date (see Disease_Model.update_tallies)
+  def tally_state(self):
+    return self.state & self.TALLIED
+
+# A class representing a 'human' agent.
+class Human_Agent(Disease_Agent):
+  __slots__ = ("treat_length",)
+
+  is_human = True
+  # The model reports how many humans are infected, susceptible, exposed
+  # and removed
+  TALLIED = INFECTED | SUSCEPTIBLE | EXPOSED | REMOVED
+  # potential fix, do not remove:
+  human_susceptible = Disease_Agent.susceptible
+  human_infected = Disease_Agent.infected
+
   # Constructor
-  def __init__(self, unique_id, model, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, treatment_chance, treatment_length, isolation):
+  def __init__(self, unique_id, model, params):
     # Call the constructor from the parent Agent class, which will do all
     # the hard work of defining what an agent is - we just give it an ID
     # and a model that it will live in
     super().__init__(unique_id, model)
 
     # Now we define the attributes of our Human Agent that aren't in the parent class
-    # First, we specify the level of transmissiblity (the probability of passing the disease onto someone else after contact with them
-    # assuming this agent is infected, and the other one isn't)
-    self.transmissibility = transmissibility
-
-    # The probability that the agent will move from its current location
-    # at any given time step
-    self.level_of_movement = level_of_movement
+    # The parameters shared by all humans (a Human_Parameters object)
+    self.params = params
 
-    # Average duration of being infected with the disease
-    self.mean_length_of_disease = mean_length_of_disease
+    # Every human starts out susceptible
+    self.state = SUSCEPTIBLE
+    self.treat_length = params.treatment_length
+    # Whether the agent is in the grid's index of humans that can be exposed
+    self.indexed = self.index_state()
 
-    # Duration of treatment
-    self.length_of_treatment = treatment_length
-
-    self.is_human = True 
-    self.infected = False
-    self.susceptible = True
-    self.exposed = False
-    self.removed = False
-    self.death = False
-    self.treat_length = treatment_length
-    self.treat_chance = treatment_chance
-    self.iso_chance = isolation
-    # potential fix, do not remove:
-    self.human_susceptible = self.susceptible
-    self.human_infected = self.infected
+  # Humans are kept in the grid's index (see Disease_Grid) while they can be
+  # exposed by an infected rodent
+  def index_state(self):
+    return self.state & (INFECTED | EXPOSED) == 0
 
   # Agent movement function - this is called if it is determined the agent
   # is going to move on this time step
   def move(self):
-    # Get a list of possible neighbouring cells to which to move
-    # we use the get_neighborhood function, giving it the agent's current
-    # position on the grind, stating we want a Moore neighbourhood (which
-    # includes diagonals), and that we don't want to include the centre
-    # (where the agent is currently) in the returned neighbourhood list
-    possible_steps = self.model.grid.get_neighborhood(self.pos, moore=True, include_center=False)
-
-    # Select new position at random
-    new_position = random.choice(possible_steps)
+    # Select new position at random from the neighbouring cells (the Moore
+    # neighbourhood, which includes diagonals but not the cell the agent is
+    # currently in). These are looked up in the model's neighbour table
+    # rather than worked out again on every move.
+    new_position = self.model.random_neighbour(self.pos, self.model.human_random)
 
     # Move the agent tothe randomly selected new position
     self.model.grid.move_agent(self, new_position)
   
   # Step method - this defines which of the agent's actions will be taken
-  # on a time step, and in which order
+  # on a time step, and in which order. We work on a local copy of the
+  # agent's compartment bits, and store it back at the end.
   def step(self):
-    # For Isolation length
-    if self.removed == True:
+    rng = self.model.human_random
+    params = self.params
+    state = before = self.state
+
+    # For Isolation length (once it's over the agent stays removed)
+    if state & REMOVED:
       self.treat_length -= 1
-      if self.treat_length <= 0:
-        self.removed = True
-        # self.susceptible = True
 
     # Move with given probability 
-    if (random.uniform(0, 1) < self.level_of_movement) and (self.removed == False):
+    if (rng.uniform(0, 1) < params.level_of_movement) and not state & REMOVED:
       self.move()
 
     # Exposed
-    if self.exposed == True:
-      self.susceptible = False
-      if random.randint(0,100) < self.treat_chance:
-        self.exposed = False
-        self.susceptible = False
-        self.human_susceptible = False
-        self.removed = True
+    if state & EXPOSED:
+      state &= ~SUSCEPTIBLE
+      if rng.randint(0,100) < params.treatment_chance:
+        # treated - no longer exposed, and removed
+        state = (state & ~EXPOSED) | REMOVED
       else:
-        if random.uniform(0, 1) < self.transmissibility:
-          self.exposed = False
-          self.infected = True
-          self.human_infected = True
-          self.susceptible = False
-          self.human_susceptible = False
-          self.removed = False
-          self.disease_duration = int(round(random.expovariate(1.0 / self.mean_length_of_disease), 0))
+        if rng.uniform(0, 1) < params.transmissibility:
+          # infected
+          state = (state & ~(EXPOSED | REMOVED)) | INFECTED
+          self.disease_duration = int(round(rng.expovariate(1.0 / params.mean_length_of_disease), 0))
         else:
-          self.exposed = False
-          self.susceptible = True
-          self.human_susceptible = True
+          # back to being susceptible
+          state = (state & ~EXPOSED) | SUSCEPTIBLE
           
-      if random.randint(0,100) < self.treat_chance:
-        self.exposed = False
-        self.susceptible = False
-        self.human_susceptible = False
-        self.removed = True
+      if rng.randint(0,100) < params.treatment_chance:
+        state = (state & ~(EXPOSED | SUSCEPTIBLE)) | REMOVED
     
-    # Begin infecting cellmates (if agent is infected), and update
-    # remaining disease duration
-    if self.infected == True:
-      # self.infect()
+    # Update remaining disease duration (if agent is infected)
+    if state & INFECTED:
       # decrement remaining disease duration by one time unit
       self.disease_duration -= 1
 
       # if disease has now run its course, flag that the agent is no
-      # longer infected
+      # longer infected, and removed
       if self.disease_duration <= 0:
-        self.infected = False
-        self.human_infected = False
-        self.susceptible = False
-        self.human_susceptible = False
-        self.removed = True
+        state = (state & ~(INFECTED | SUSCEPTIBLE)) | REMOVED
+
+    if state != before:
+      self.state = state
+      self.model.update_tallies(before & self.TALLIED, state & self.TALLIED)
+      self.model.grid.update_index(self)
   
 # ===================================
 # rodents class
-class Rodent_Agent(Agent):
+class Rodent_Agent(Disease_Agent):
+  __slots__ = ()
+
+  is_human = False
+  # The model only reports how many rodents have died
+  TALLIED = DEAD
+  # test, dont remove
+  human_susceptible = False
+  human_infected = False
+
   # Constructor
-  def __init__(self, unique_id, model, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, environmental, pesticide):
+  def __init__(self, unique_id, model, params):
     # Call the constructor from the parent Agent class, which will do all
     # the hard work of defining what an agent is - we just give it an ID
     # and a model that it will live in
     super().__init__(unique_id, model)
     
     # Now we define the attributes of our Rodent Agent that aren't in the parent class
-    # First, we specify the level of transmissiblity (the probability of passing the disease onto someone else after contact with them
-    # assuming this agent is infected, and the other one isn't)
-    self.transmissibility = transmissibility
-
-    # The probability that the agent will move from its current location
-    # at any given time step
-    self.level_of_movement = level_of_movement
-
-    # Average duration of being infected with the disease
-    self.mean_length_of_disease = mean_length_of_disease
-
-    self.is_human = False 
-    self.death = False
-    self.pesticide_level = pesticide
-    self.environmental_level = environmental
-    self.exposed = False
-    self.removed = False
-    # test, dont remove
-    self.human_susceptible = False
-    self.human_infected = False
+    # The parameters shared by all rodents (a Rodent_Parameters object)
+    self.params = params
 
     # We're going to set up our model so that some agents are already
     # infected at the start. We've got a paramter value passed in
     # (initial infection) that defines the probability of any given agent 
     # being infected at the start. So, we just randomly sample from 
     # uniform distribution between 0 and 1, and if the sampled value is
-    # less than this probability, then we say that the agent is infected -
-    # we set their Boolean infected attribute to True, and randomly
-    # sample a duration we passed in. Otherwise, we set their infected attribute to false
-    if random.uniform(0, 1) < initial_infection:
-      self.infected = True
-      self.susceptible = False
-      self.disease_duration = int(round(random.expovariate(1.0 / self.mean_length_of_disease), 0))
+    # less than this probability, then we say that the agent is infected
+    # and randomly sample a duration we passed in. Otherwise, the agent is
+    # susceptible
+    rng = model.rodent_random
+    if rng.uniform(0, 1) < params.initial_infection:
+      self.state = INFECTED
+      self.disease_duration = int(round(rng.expovariate(1.0 / params.mean_length_of_disease), 0))
     else:
-      self.infected = False
-      self.susceptible = True
+      self.state = SUSCEPTIBLE
+    # Whether the agent is counted in the grid's index of infected rodents
+    self.indexed = self.index_state()
+
+  # Rodents are counted in the grid's index (see Disease_Grid) while they're
+  # infected
+  def index_state(self):
+    return self.state & INFECTED != 0
 
   # @41:36 ✔️
   # Agent movement function - this is called if it is determined the agent
   # is going to move on this time step
   def move(self):
-    # Get a list of possible neighbouring cells to which to move
-    # we use the get_neighborhood function, giving it the agent's current
-    # position on the grind, stating we want a Moore neighbourhood (which
-    # includes diagonals), and that we don't want to include the centre
-    # (where the agent is currently) in the returned neighbourhood list
-    possible_steps = self.model.grid.get_neighborhood(self.pos, moore=True, include_center=False)
-
-    # Select new position at random
-    new_position = random.choice(possible_steps)
+    # Select new position at random from the neighbouring cells (the Moore
+    # neighbourhood, which includes diagonals but not the cell the agent is
+    # currently in). These are looked up in the model's neighbour table
+    # rather than worked out again on every move.
+    new_position = self.model.random_neighbour(self.pos, self.model.rodent_random)
 
     # Move the agent to the randomly selected new position
     self.model.grid.move_agent(self, new_position)
 
   # Agent infection function
   def infect(self):
-    # Get list of agents in this cell. We use the get_cell_list_contents
-    # function of the grid object and pass it our current position
-    cellmates = self.model.grid.get_cell_list_contents([self.pos])
-
-    # Check if there are other agents here - if the list of cellmates is 
-    # greater than 1 then there must be more here than this agent
-    if len(cellmates) > 1:
-      # for each agent in the cell
-      for inhabitant in cellmates:
-        # infect the agent with a given probability (transmissibility)
-        # if they're not already infected. If they become infected,
-        # then we set their infected attribute to True, and their
-        # disease_duration attribute to a value randomly sampled based
-        # on the mean_length_of_distance attribute.
-        if inhabitant.infected == False and inhabitant.is_human:
-          if self.infected == True:
-            inhabitant.exposed = True
-            inhabitant.susceptible = False
-            inhabitant.human_susceptible = False
-        elif inhabitant.exposed == True:
-          if self.infected == True:
-            inhabitant.infected == True
-            inhabitant.human_infected = True
-            inhabitant.exposed = False
-            inhabitant.susceptible = False
-            inhabitant.human_susceptible = False
+    # Get the humans in this cell who can be exposed - those who aren't
+    # already infected or exposed. The grid keeps these in an index, so we
+    # don't have to look through every agent in the cell. Once exposed they
+    # drop out of the index, so if there's more than one infected rodent in
+    # the cell, the ones that come after find nobody left to expose.
+    exposable = self.model.grid.exposable_humans.get(self.pos)
+
+    if exposable:
+      # for each human that can be exposed, flag them as exposed (whether
+      # they go on to become infected is decided in their own step)
+      for inhabitant in list(exposable):
+        before = inhabitant.state
+        inhabitant.state = (before & ~SUSCEPTIBLE) | EXPOSED
+        self.model.update_tallies(before & inhabitant.TALLIED, inhabitant.state & inhabitant.TALLIED)
+        self.model.grid.update_index(inhabitant)
 
   def pesticideFactor(self):
-    if random.randint(0,100) < self.pesticide_level:
-      self.death = True
-      self.infected = False
-      self.susceptible = False
+    if self.model.rodent_random.randint(0,100) < self.params.pesticide:
+      before = self.state
+      self.state = (before & ~(INFECTED | SUSCEPTIBLE)) | DEAD
+      self.model.update_tallies(before & self.TALLIED, self.state & self.TALLIED)
+      self.model.grid.update_index(self)
     
   # Step method - this defines which of the agent's actions will be taken
   # on a time step, and in which order
   def step(self):
     # Pesticide function that will determine if a rodent will die or not
     self.pesticideFactor()
-    if self.death == True:
+    if self.state & DEAD:
+      # Take dead rodents out of the model, so they aren't stepped again
+      if self.model.prune_dead:
+        self.model.remove_dead(self)
       return
+    rng = self.model.rodent_random
     # Environmental if loop that will determine if a rodent will move or not
-    if random.randint(0,100) < self.environmental_level:
+    if rng.randint(0,100) < self.params.environmental:
       return
     else:
       # Move with given probability 
-      if random.uniform(0, 1) < self.level_of_movement:
+      if rng.uniform(0, 1) < self.params.level_of_movement:
         self.move()
 
-    self.exposed = False
     # Begin infecting cellmates (if agent is infected), and update
     # remaining disease duration
-    if self.infected == True:
+    if self.state & INFECTED:
       self.infect()
       # decrement remaining disease duration by one time unit
       self.disease_duration -= 1
@@ -246,8 +367,128 @@ class Rodent_Agent(Agent):
       # if disease has now run its course, flag that the agent is no
       # longer infected
       if self.disease_duration <= 0:
-        self.infected = False
-        self.susceptible = True
+        self.state = (self.state & ~INFECTED) | SUSCEPTIBLE
+        self.model.grid.update_index(self)
+
+
+# Versions of the agents used when the model is profiling (see
+# disease_profile.py). They time and count what the agents do and hand the
+# results to the model's profiler, so the plain agents above don't pay for
+# any of it when profiling is off.
+class Profiled_Human_Agent(Human_Agent):
+  __slots__ = ()
+
+  def move(self):
+    profiler = self.model.profiler
+    start = perf_counter()
+    super().move()
+    profiler.times["movement"] += perf_counter() - start
+    profiler.counts["moves"] += 1
+
+  def step(self):
+    profiler = self.model.profiler
+    before = self.state
+    moving = profiler.times["movement"]
+    start = perf_counter()
+    super().step()
+    seconds = perf_counter() - start
+    # Everything but moving is exposure, treatment and recovery
+    profiler.times["human_update"] += seconds - (profiler.times["movement"] - moving)
+    profiler.agent_seconds += seconds
+    profiler.counts["agent_steps"] += 1
+    if self.state != before:
+      profiler.counts["transitions"] += 1
+
+class Profiled_Rodent_Agent(Rodent_Agent):
+  __slots__ = ()
+
+  def move(self):
+    profiler = self.model.profiler
+    start = perf_counter()
+    super().move()
+    profiler.times["movement"] += perf_counter() - start
+    profiler.counts["moves"] += 1
+
+  def infect(self):
+    profiler = self.model.profiler
+    # Every human looked at is exposed
+    exposable = len(self.model.grid.exposable_humans.get(self.pos) or ())
+    start = perf_counter()
+    super().infect()
+    profiler.times["infection"] += perf_counter() - start
+    profiler.counts["infect_calls"] += 1
+    profiler.counts["cellmates_scanned"] += exposable
+    profiler.counts["transitions"] += exposable
+
+  def step(self):
+    profiler = self.model.profiler
+    before = self.state
+    elsewhere = profiler.times["movement"] + profiler.times["infection"]
+    start = perf_counter()
+    super().step()
+    seconds = perf_counter() - start
+    # Everything but moving and infecting is pesticide, recovery and
+    # removing the dead
+    profiler.times["rodent_update"] += seconds - (profiler.times["movement"] + profiler.times["infection"] - elsewhere)
+    profiler.agent_seconds += seconds
+    profiler.counts["agent_steps"] += 1
+    if self.state != before:
+      profiler.counts["transitions"] += 1
+
+
+# Rules for ending a run early, checked after every step. A run can stop
+# once the disease has died out (no infected rodents and no infected or
+# exposed humans), once none of the reported compartments has changed for
+# stable_steps steps in a row, or after max_steps steps. check() returns the
+# reason for stopping ("extinction", "stable" or "max_steps"), or None to
+# carry on, and update() also stops the model if there is one. Every
+# version of the model (vectorized, sharded and surrogate) stops this way.
+class Termination_Criteria:
+  def __init__(self, stop_on_extinction=False, stable_steps=None, max_steps=None):
+    self.stop_on_extinction = stop_on_extinction
+    self.stable_steps = stable_steps
+    self.max_steps = max_steps
+    self.last_counts = None
+    self.unchanged_steps = 0
+
+  # step is the number of steps run so far, counts the current values of
+  # the five reported compartments, and infected_rodents the number of
+  # rodents currently infected
+  def check(self, step, counts, infected_rodents):
+    if counts == self.last_counts:
+      self.unchanged_steps += 1
+    else:
+      self.unchanged_steps = 0
+      self.last_counts = counts
+
+    infected_humans, susceptible_humans, deceased_rodents, exposed_humans, removed_humans = counts
+    if self.stop_on_extinction and infected_rodents == 0 and infected_humans == 0 and exposed_humans == 0:
+      return "extinction"
+    if self.stable_steps is not None and self.unchanged_steps >= self.stable_steps:
+      return "stable"
+    if self.max_steps is not None and step >= self.max_steps:
+      return "max_steps"
+    return None
+
+  # End model's run at the given step: set running to False, record why
+  # and when it stopped (in stop_reason and stop_step, and the
+  # datacollector's "Termination" table), and write out anything a
+  # streaming datacollector still has buffered
+  def stop(self, model, reason, step):
+    model.running = False
+    model.stop_reason = reason
+    model.stop_step = step
+    model.datacollector.add_table_row("Termination", {"Stop Reason":reason, "Stop Step":step})
+    if isinstance(model.datacollector, Streaming_DataCollector):
+      model.datacollector.flush()
+
+  # Check whether model's run should stop after this step (as for check)
+  # and stop it if so. Returns the reason it stopped, or None.
+  def update(self, model, step, counts, infected_rodents):
+    reason = self.check(step, counts, infected_rodents)
+    if reason is not None:
+      self.stop(model, reason, step)
+    return reason
 
 
 class Disease_Model(Model):
@@ -257,141 +498,300 @@ class Disease_Model(Model):
   # The comment below which uses triple " will get picked up by the server
   # if we run a live display of the model.
   """A model of how Lassa Fever spreads and how different interventions effect the overall virus spread and reproduction rate. KEY: Circles = Humans, Squares = Rodents"""
-  def __init__(self, N, width, height, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, rodent_population, treatment_chance, treatment_length, isolation, environmental, pesticide):
+  def __init__(self, N, width, height, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, rodent_population, treatment_chance, treatment_length, isolation, environmental, pesticide, seed=None, prune_dead=True, stop_on_extinction=False, stable_steps=None, max_steps=None, debug=False, profile=False):
     self.running = True # required for BatchRunner
     self.num_humans = N # assign number of humans at initialisation
     self.num_rodents = rodent_population # assign number of rodents at initialisation
     agent_id_count = 0 # for assigning each agent (both rodent & human) with their own unique ID number
 
+    # Running tallies of each compartment, kept up to date by the agents
+    # whenever they change state, so the model reporters don't have to scan
+    # every agent on every step. If debug is switched on, the tallies are
+    # checked against a full scan of the agents after every step.
+    self.total_infected = 0
+    self.total_susceptible = 0
+    self.total_deceased = 0
+    self.total_exposed = 0
+    self.total_removed = 0
+    self.debug = debug
+
+    # Rodents killed by pesticide are taken off the schedule and the grid
+    # (unless prune_dead is switched off, e.g. to keep drawing them in the
+    # browser), so each step only has to deal with the living. They stay
+    # counted in the Deceased Rodents tally.
+    self.prune_dead = prune_dead
+    self.num_pruned = 0
+
+    # When to stop the run early (see Termination_Criteria). When the run
+    # stops, running is set to False and the reason and step are recorded
+    # here and in the datacollector's "Termination" table.
+    self.termination = Termination_Criteria(stop_on_extinction, stable_steps, max_steps)
+    self.stop_reason = None
+    self.stop_step = None
+
+    # If profile is switched on, the time spent in each phase of every step
+    # and the number of moves, infections and so on are recorded in the
+    # datacollector's "Profile" table (see disease_profile.py). With
+    # profile="trace", a trace of the run is kept as well.
+    self.profile = profile
+    self.profiler = Step_Profiler(trace=profile == "trace") if profile else None
+    human_class = Profiled_Human_Agent if profile else Human_Agent
+    rodent_class = Profiled_Rodent_Agent if profile else Rodent_Agent
+    self.agent_classes = (human_class, rodent_class)
+
+    # The model's own random number streams, all spawned from the seed we're
+    # given, so the same seed always gives exactly the same run. Humans,
+    # rodents, initial placement and the scheduler each draw from their own
+    # independent stream. (self.random is the stream mesa's scheduler uses
+    # to shuffle the order agents are activated in.)
+    self.seed = seed
+    setup_seed, human_seed, rodent_seed, schedule_seed = spawn_seeds(seed, 4)
+    self.setup_random = Random_Stream(setup_seed)
+    self.human_random = Random_Stream(human_seed)
+    self.rodent_random = Random_Stream(rodent_seed)
+    self.random = Random_Stream(schedule_seed)
+
     # Set up Toroidal multi-grid (Toroidal = if the agent is in a cell
     # on the border of the grid, and moves towards the border, they'll
-    # come out the other side. Think PacMan :) The True Boolean passed in
-    # switches that on. Multi-grid just means we can have more than one
-    # agent per cell)
-    self.grid = MultiGrid(width, height, True)
+    # come out the other side. Think PacMan :) Multi-grid just means we can
+    # have more than one agent per cell). Disease_Grid is a MultiGrid that
+    # also indexes the humans and infected rodents in each cell.
+    self.grid = Disease_Grid(width, height)
+    # Table of every cell's neighbours, used when agents move. The flat copy
+    # is for looking up one agent's move at a time, which is quicker from an
+    # array than from NumPy.
+    self.neighbour_cells = moore_neighbour_table(width, height)
+    self.neighbour_list = array("q", self.neighbour_cells.ravel())
     # set up a scheduler with random order of agents being activated
     # each turn. Remember order is important here - if an infected agent
     # is going to move into a cell with an uninfected agent, but that
     # uninfected agent moves first, they'll escape infection.
     self.schedule = RandomActivation(self)
 
+    # Parameters shared by all the humans, and by all the rodents
+    self.human_params = Human_Parameters(transmissibility, level_of_movement, mean_length_of_disease, treatment_chance, treatment_length, isolation)
+    self.rodent_params = Rodent_Parameters(initial_infection, transmissibility, level_of_movement, mean_length_of_disease, environmental, pesticide)
+
+    # Pick the starting cell of every agent (humans first, then rodents)
+    start_cells = self.start_cells(self.num_humans + self.num_rodents)
+
     # Create human_agent objects up to number specified
     for i in range(self.num_humans):
       # Create agent with ID taken from for loop
-      a = Human_Agent(i, self, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, treatment_chance, treatment_length, isolation)
+      a = human_class(i, self, self.human_params)
       self.schedule.add(a) # add agent to the schedule
-      # Try adding the agent to a random empty cell
-      try:
-        start_cell = self.grid.find_empty()
-        self.grid.place_agent(a, start_cell)
-      # If you can't find an empty cell, just pick any cell at randomS
-      except:
-        x = random.randrange(self.grid.width)
-        y = random.randrange(self.grid.height)
-        self.grid.place_agent(a, (x,y))
+      self.update_tallies(NO_TALLY_STATE, a.tally_state())
+      self.grid.place_agent(a, start_cells[i]) # add agent to its starting cell
       agent_id_count += 1
 
     # Create rodent_agent objects up to number specified
     for i in range(self.num_rodents):
       # Create agent with ID taken from for loop
-      a = Rodent_Agent(i + agent_id_count, self, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, environmental, pesticide)
+      a = rodent_class(i + agent_id_count, self, self.rodent_params)
       self.schedule.add(a) # add agent to the schedule
-      # Try adding the agent to a random empty cell
-      try:
-        start_cell = self.grid.find_empty()
-        self.grid.place_agent(a, start_cell)
-      # If you can't find an empty cell, just pick any cell at randomS
-      except:
-        x = random.randrange(self.grid.width)
-        y = random.randrange(self.grid.height)
-        self.grid.place_agent(a, (x,y))
-        
+      self.update_tallies(NO_TALLY_STATE, a.tally_state())
+      self.grid.place_agent(a, start_cells[i + agent_id_count]) # add agent to its starting cell
+
     # Create a new datacollector, and pass in a model reporter as a
     # dictionary entry, with the index value as the name of the result
     # (which we'll refer to by this name elsewhere) and the lookup value
     # as the name of the function we created below that will calculate
     # the result we're reporting
+    tables = {"Termination":["Stop Reason", "Stop Step"]}
+    if profile:
+      tables["Profile"] = PROFILE_COLUMNS
     self.datacollector = DataCollector(
       model_reporters={"Infected Humans":calculate_number_infected,
                        "Susceptible Humans":calculate_number_susceptible,
                        "Deceased Rodents":calculate_number_deceased,
                        "Exposed Humans":calculate_number_exposed,
                        "Removed/Recovered/Isolated Humans":calculate_number_removed},
-      agent_reporters={}
+      agent_reporters={},
+      tables=tables
       )
 
+  # Starting cells for n agents. Each agent goes into a random empty cell
+  # while there are any left, and into any cell at random once the grid is
+  # full. Rather than searching for an empty cell for each agent in turn
+  # (which grows with the number of cells), we shuffle the list of every
+  # cell once and hand the cells out in that order, so setup time grows
+  # linearly with the number of agents.
+  def start_cells(self, n):
+    generator = self.setup_random.generator
+    num_cells = self.grid.width * self.grid.height
+    cells = generator.permutation(num_cells)[:n]
+    if n > num_cells:
+      cells = np.concatenate([cells, generator.integers(0, num_cells, n - num_cells)])
+    return list(zip((cells // self.grid.height).tolist(), (cells % self.grid.height).tolist()))
+
+  # Pick a random neighbouring cell of pos, drawing from the given random
+  # stream
+  def random_neighbour(self, pos, rng):
+    x, y = pos
+    cell = self.neighbour_list[(x * self.grid.height + y) * 8 + int(rng.random() * 8)]
+    return divmod(cell, self.grid.height)
+
+  # Remove a dead agent from the schedule and the grid
+  def remove_dead(self, agent):
+    self.schedule.remove(agent)
+    self.grid.remove_agent(agent)
+    self.num_pruned += 1
+
+  # Apply an agent's change of state to the running tallies. before and after
+  # are the agent's tally_state() from before and after the change.
+  def update_tallies(self, before, after):
+    changed = before ^ after
+    if changed:
+      if changed & INFECTED:
+        self.total_infected += 1 if after & INFECTED else -1
+      if changed & SUSCEPTIBLE:
+        self.total_susceptible += 1 if after & SUSCEPTIBLE else -1
+      if changed & DEAD:
+        self.total_deceased += 1 if after & DEAD else -1
+      if changed & EXPOSED:
+        self.total_exposed += 1 if after & EXPOSED else -1
+      if changed & REMOVED:
+        self.total_removed += 1 if after & REMOVED else -1
+
+  # Check the running tallies against a full scan of every agent, raising an
+  # error naming any compartment where they disagree
+  def check_tallies(self):
+    tallies = {"Infected Humans":self.total_infected,
+               "Susceptible Humans":self.total_susceptible,
+               "Deceased Rodents":self.total_deceased,
+               "Exposed Humans":self.total_exposed,
+               "Removed/Recovered/Isolated Humans":self.total_removed}
+    counts = count_compartments(self)
+    mismatched = ["{} (tally {}, scan {})".format(name, tallies[name], counts[name])
+                  for name in tallies if tallies[name] != counts[name]]
+    if mismatched:
+      raise AssertionError("Compartment tallies out of step at step {}: {}".format(self.schedule.steps, ", ".join(mismatched)))
+
+  # Check the grid's index of exposable humans and infected rodents against
+  # a full scan of every agent, raising an error if they disagree
+  def check_index(self):
+    exposable_humans = {}
+    infected_rodents = {}
+    for agent in self.schedule.agents:
+      if agent.index_state():
+        if agent.is_human:
+          exposable_humans.setdefault(agent.pos, set()).add(agent)
+        else:
+          infected_rodents[agent.pos] = infected_rodents.get(agent.pos, 0) + 1
+    indexed_humans = {pos:humans for pos, humans in self.grid.exposable_humans.items() if humans}
+    indexed_rodents = {pos:count for pos, count in self.grid.infected_rodents.items() if count}
+    if (indexed_humans != exposable_humans or indexed_rodents != infected_rodents
+        or self.grid.num_infected_rodents != sum(infected_rodents.values())):
+      raise AssertionError("Grid index out of step at step {}".format(self.schedule.steps))
+
   # Function to advance the mode by one step
   def step(self):
+    # When profiling, the profiler runs the step so it can time each part
+    if self.profiler is not None:
+      self.profiler.step(self)
+      # The step's Profile row is added after the run may have stopped (and
+      # had its buffered data written out), so write that out too
+      if not self.running:
+        self.finish_streaming()
+      return
     self.schedule.step()
+    if self.debug:
+      self.check_tallies()
+      self.check_index()
     # Tell the datacollector to collect data from the specified model
     # and agent reporters
     self.datacollector.collect(self)
-
-# Function to calculate total number infected in the model
-# The function takes as an input model object for which we want to calculate
-# these results
+    self.check_termination()
+
+  # Check whether the run should stop here
+  def check_termination(self):
+    counts = (self.total_infected, self.total_susceptible, self.total_deceased, self.total_exposed, self.total_removed)
+    self.termination.update(self, self.schedule.steps, counts, self.grid.num_infected_rodents)
+
+  # End the run, recording why and at which step it stopped
+  def stop(self, reason):
+    self.termination.stop(self, reason, self.schedule.steps)
+
+  # Send the collected data to part files under path rather than keeping it
+  # all in memory (see Streaming_DataCollector in disease_collector.py).
+  # Call this before the first step. Agent snapshots are taken with
+  # agent_snapshot every agent_snapshot_every steps, if given. Data is
+  # written out buffer_steps steps at a time, so call finish_streaming once
+  # you've finished stepping the model to write out the rest (a run that
+  # stops itself does this when it stops).
+  def stream_data(self, path, buffer_steps=1000, agent_snapshot_every=None, file_format=None):
+    self.datacollector = Streaming_DataCollector(path, self.datacollector.model_reporters,
+                                                 {name:list(columns) for name, columns in self.datacollector.tables.items()},
+                                                 buffer_steps, agent_snapshot_every, file_format)
+
+  # Write out whatever a streaming datacollector (see stream_data) still
+  # has buffered, so everything collected so far is on disk. Does nothing
+  # if the data isn't being streamed.
+  def finish_streaming(self):
+    if isinstance(self.datacollector, Streaming_DataCollector):
+      self.datacollector.flush()
+
+  # The current state of every agent in the model, as columns
+  def agent_snapshot(self):
+    snapshot = {"unique_id":[], "is_human":[], "x":[], "y":[], "infected":[],
+                "susceptible":[], "exposed":[], "removed":[], "death":[]}
+    for agent in self.schedule.agents:
+      x, y = agent.pos
+      snapshot["unique_id"].append(agent.unique_id)
+      snapshot["is_human"].append(agent.is_human)
+      snapshot["x"].append(x)
+      snapshot["y"].append(y)
+      snapshot["infected"].append(agent.infected)
+      snapshot["susceptible"].append(agent.susceptible)
+      snapshot["exposed"].append(agent.exposed)
+      snapshot["removed"].append(agent.removed)
+      snapshot["death"].append(agent.death)
+    return snapshot
+
+# The flags counted by the model reporters, for an agent that hasn't been
+# added to the model yet
+NO_TALLY_STATE = 0
+
+# Functions to report the total number in each compartment. These take as an
+# input the model object for which we want to calculate these results, and
+# read the running tallies that the agents keep up to date as they change
+# state, so reporting doesn't need to look at every agent.
 def calculate_number_infected(model):
-  # set up a counter with default value of 0 that wil keep count of the
-  # total number infected
-  total_infected = 0
+  return model.total_infected
 
-  # use list comprehnsion to establish a new list that contains the
-  # infected variable value of each agent in the model
-  infection_report = [agent.human_infected for agent in model.schedule.agents]
-
-  # loop through the stored variable values which indicate whether each
-  # agent is infected, and for each one that is True increment the total
-  # number of infected by 1
-  for x in infection_report:
-    if x == True:
-      total_infected += 1
-
-  # Return the total number of infected as the output from the function
-  return total_infected
-
-# Function to calculate total number susceptible in the model
 def calculate_number_susceptible(model):
-  total_susceptible = 0
-
-  susceptible_report = [agent.human_susceptible for agent in model.schedule.agents]
+  return model.total_susceptible
 
-  for x in susceptible_report:
-    if x == True:
-      total_susceptible  += 1
-  
-  return total_susceptible
-
-#Function to calculate total number of deceased rodents in the model
 def calculate_number_deceased(model):
-  total_deceased = 0
-
-  deceased_report = [agent.death for agent in model.schedule.agents]
-
-  for x in deceased_report:
-    if x == True:
-      total_deceased  += 1
-  
-  return total_deceased
+  return model.total_deceased
 
 def calculate_number_exposed(model):
-  total_exposed = 0
-
-  exposed_report = [agent.exposed for agent in model.schedule.agents]
-
-  for x in exposed_report:
-    if x == True:
-      total_exposed += 1
-  
-  return total_exposed
+  return model.total_exposed
 
 def calculate_number_removed(model):
-  total_removed = 0
+  return model.total_removed
 
-  removed_report = [agent.removed for agent in model.schedule.agents]
+# Count every compartment with a single full scan of the agents in the model
+# (plus any dead rodents that have been removed from it).
+# This is what the running tallies should always add up to, and is used to
+# check them when the model is run in debug mode.
+def count_compartments(model):
+  total_infected = 0
+  total_susceptible = 0
+  total_deceased = model.num_pruned # dead rodents no longer in the model
+  total_exposed = 0
+  total_removed = 0
 
-  for x in removed_report:
-    if x == True:
-      total_removed += 1
-  
-  return total_removed
-  
\ No newline at end of file
+  for agent in model.schedule.agents:
+    total_infected += agent.human_infected
+    total_susceptible += agent.human_susceptible
+    total_deceased += agent.death
+    total_exposed += agent.exposed
+    total_removed += agent.removed
+
+  return {"Infected Humans":total_infected,
+          "Susceptible Humans":total_susceptible,
+          "Deceased Rodents":total_deceased,
+          "Exposed Humans":total_exposed,
+          "Removed/Recovered/Isolated Humans":total_removed}
+  # @1:26:11 ✔️
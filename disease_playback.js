@@ -0,0 +1,23 @@
+// Browser side of Playback_Server (disease_playback.py). The server starts a
+// new model whenever a slider is changed, and sends "model_reset" when it
+// does; mesa's page only starts its step counter and charts again when the
+// Reset button is pressed, so this does the same for the server's resets
+// (without asking the server to reset the model a second time).
+var listenForModelReset = function() {
+    var handleMessage = ws.onmessage;
+    ws.onmessage = function(message) {
+        var msg = JSON.parse(message.data);
+        if (msg.type !== "model_reset") {
+            handleMessage(message);
+            return;
+        }
+        clearTimeout(controller.timeout);
+        controller.tick = 0;
+        stepDisplay.innerText = controller.tick;
+        vizElements.forEach(function(element) { element.reset(); });
+        if (controller.finished) {
+            controller.finished = false;
+            startModelButton.firstElementChild.innerText = "Start";
+        }
+    };
+};
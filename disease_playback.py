@@ -0,0 +1,183 @@
+import queue
+import threading
+
+import tornado.escape
+import tornado.ioloop
+from mesa.visualization.ModularVisualization import ModularServer, SocketHandler
+from mesa.visualization.UserParam import UserSettableParameter
+
+# A ModularServer that steps the model in a background thread rather than
+# inside the websocket handler. Mesa's own server runs each step when the
+# browser asks for the next frame, so the page stalls for as long as the step
+# takes. Here a worker thread runs ahead of the browser, stepping the model
+# and rendering frames into a bounded buffer (buffer_frames long), and the
+# browser's requests for the next frame are answered from the buffer - so a
+# slow step is hidden as long as the model keeps up on average.
+#
+# The server also steps the model a number of times for every frame it sends
+# (set with a "steps_per_frame" slider), so the model can run at full speed
+# while the browser only draws every Kth step.
+#
+# Resetting the model, or changing any of the model's sliders, stops the
+# worker, throws away the frames it had buffered and starts a new model with
+# the current settings. A new worker is started when the browser next asks
+# for a frame. The old worker is told to stop rather than waited for - it
+# stops after the step it's on, and never renders another frame - so a slow
+# step doesn't hold up the reset. After a slider change the browser is told
+# the model has been reset (see disease_playback.js), so its step counter
+# and charts start again along with the model.
+
+# Setting (taken from the server's model parameters, but not passed to the
+# model) for how many steps to run for each frame sent to the browser
+FRAME_SKIP_SETTING = "steps_per_frame"
+
+# Put in the frame buffer once the model has stopped running
+END_OF_RUN = "end"
+
+# Sent to the browser when the model has been reset because a slider changed
+MODEL_RESET = "model_reset"
+
+
+class Frame_Worker(threading.Thread):
+  def __init__(self, server, model, buffer_frames):
+    super().__init__(daemon=True)
+    self.server = server
+    self.model = model
+    self.frames = queue.Queue(maxsize=buffer_frames)
+    self.cancelled = threading.Event()
+
+  def run(self):
+    try:
+      while not self.cancelled.is_set():
+        if not self.model.running:
+          self.put(END_OF_RUN)
+          return
+        for i in range(self.server.steps_per_frame):
+          if self.cancelled.is_set():
+            return
+          self.model.step()
+          if not self.model.running:
+            break
+        frame = self.server.render(self.model, self.cancelled)
+        if frame is not None:
+          self.put(frame)
+    except Exception as error:
+      # Hand the error over to be raised where the frame is asked for
+      self.put(error)
+
+  # Add a frame to the buffer, waiting while the buffer is full unless the
+  # worker is cancelled
+  def put(self, frame):
+    while not self.cancelled.is_set():
+      try:
+        self.frames.put(frame, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  # Take the next frame from the buffer, waiting for one if it's empty.
+  # Returns None if the worker is cancelled first.
+  def get(self):
+    while not self.cancelled.is_set():
+      try:
+        return self.frames.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    return None
+
+  # Tell the worker to stop. It isn't waited for: it stops by itself after
+  # the step it's on, and doesn't touch anything but its own model after this.
+  def cancel(self):
+    self.cancelled.set()
+
+
+class Playback_Socket_Handler(SocketHandler):
+  # Tornado waits for each message to be handled before passing on the
+  # next, so the handler can wait for a frame without another request
+  # changing the model in the meantime
+  async def on_message(self, message):
+    msg = tornado.escape.json_decode(message)
+    if msg["type"] == "get_step":
+      frame = await tornado.ioloop.IOLoop.current().run_in_executor(None, self.application.next_frame)
+      if frame is END_OF_RUN:
+        self.write_message({"type":"end"})
+      elif isinstance(frame, Exception):
+        raise frame
+      elif frame is not None:
+        self.write_message({"type":"viz_state", "data":frame})
+    elif msg["type"] == "submit_params":
+      super().on_message(message)
+      # The buffered frames are for the old settings; start again with the
+      # new ones (the number of steps per frame changes without a reset),
+      # and have the browser start its step counter and charts again too
+      if msg["param"] != FRAME_SKIP_SETTING:
+        self.application.reset_model()
+        self.write_message({"type":MODEL_RESET})
+        self.write_message(self.viz_state_message)
+    else:
+      super().on_message(message)
+
+
+class Playback_Server(ModularServer):
+  socket_handler = (r"/ws", Playback_Socket_Handler)
+  handlers = [ModularServer.page_handler, socket_handler, ModularServer.static_handler, ModularServer.local_handler]
+
+  # Frames the worker can compute ahead of the browser
+  buffer_frames = 10
+
+  def __init__(self, *args, **kwargs):
+    self.worker = None
+    # Held while rendering, as visualisation elements (e.g. the heatmap)
+    # remember what they last sent
+    self.render_lock = threading.Lock()
+    super().__init__(*args, **kwargs)
+    self.local_includes.add("disease_playback.js")
+    self.js_code.append("listenForModelReset();")
+
+  # Steps run for each frame sent to the browser
+  @property
+  def steps_per_frame(self):
+    value = self.model_kwargs.get(FRAME_SKIP_SETTING, 1)
+    return max(1, int(getattr(value, "value", value)))
+
+  def stop_worker(self):
+    if self.worker is not None:
+      self.worker.cancel()
+      self.worker = None
+
+  # As ModularServer.reset_model, but stopping the worker first and leaving
+  # the frame skip setting out of the model's parameters
+  def reset_model(self):
+    self.stop_worker()
+    model_params = {}
+    for key, val in self.model_kwargs.items():
+      if key == FRAME_SKIP_SETTING:
+        continue
+      if isinstance(val, UserSettableParameter):
+        if val.param_type == "static_text":
+          continue
+        model_params[key] = val.value
+      else:
+        model_params[key] = val
+    self.model = self.model_cls(**model_params)
+
+  # The visualisation state of a model (a frame), or None if cancelled (an
+  # Event) is set before it can be rendered
+  def render(self, model, cancelled=None):
+    with self.render_lock:
+      if cancelled is not None and cancelled.is_set():
+        return None
+      return [element.render(model) for element in self.visualization_elements]
+
+  # Only called while the worker is stopped (e.g. straight after a reset), so
+  # the model isn't being stepped at the same time
+  def render_model(self):
+    return self.render(self.model)
+
+  # The next frame for the browser, starting the worker if it isn't running.
+  # Called from a thread of its own, as it waits for the worker.
+  def next_frame(self):
+    if self.worker is None:
+      self.worker = Frame_Worker(self, self.model, self.buffer_frames)
+      self.worker.start()
+    return self.worker.get()
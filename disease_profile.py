@@ -0,0 +1,126 @@
+import json
+import os
+from contextlib import contextmanager
+from time import perf_counter
+
+# Per-step profiling for Disease_Model, switched on with profile=True. For
+# every step it records how long was spent in each phase of the step, and
+# how many of each kind of event happened, and adds them as a row of the
+# datacollector's "Profile" table:
+#
+#   model.datacollector.get_table_dataframe("Profile")
+#
+# Times are in seconds. The agents' share of a step is split between
+# movement, infection (rodents exposing humans), the rest of the humans'
+# steps (exposure, treatment and recovery) and the rest of the rodents'
+# steps (pesticide, recovery and removing the dead); whatever's left of the
+# scheduler's time is the cost of shuffling and calling the agents.
+#
+# With profile="trace", the profiler also keeps a trace of the run, which
+# export_trace writes in the Chrome trace event format, to be opened in
+# chrome://tracing or Perfetto. Phases of the model's step show up as spans
+# and the agents' phases and the event counts as counters, once per step.
+# The trace grows by a few events every step, so it's only kept when asked
+# for.
+#
+# When profiling is off, the model and agents don't touch the profiler at all.
+
+# Phases each step's time is split into, with their column names in the
+# Profile table
+PHASES = {"schedule":"Schedule",
+          "movement":"Movement",
+          "infection":"Infection",
+          "human_update":"Human Update",
+          "rodent_update":"Rodent Update",
+          "checks":"Checks",
+          "collect":"Collect",
+          "termination":"Termination"}
+
+# Events counted in each step, with their column names in the Profile table
+EVENTS = {"agent_steps":"Agent Steps",
+          "moves":"Moves",
+          "infect_calls":"Infect Calls",
+          "cellmates_scanned":"Cellmates Scanned",
+          "transitions":"State Transitions"}
+
+# Phases that happen inside the agents' steps, shown as counters in a trace
+AGENT_PHASES = ("movement", "infection", "human_update", "rodent_update")
+
+PROFILE_COLUMNS = ["Step"] + list(PHASES.values()) + list(EVENTS.values())
+
+
+class Step_Profiler:
+  # trace says whether to keep a trace of the run for export_trace
+  def __init__(self, trace=False):
+    self.start = perf_counter()
+    self.trace = trace
+    self.trace_events = []
+    self.start_step()
+
+  # Clear the times and counts ready for the next step
+  def start_step(self):
+    self.times = dict.fromkeys(PHASES, 0.0)
+    self.counts = dict.fromkeys(EVENTS, 0)
+    # Time spent inside the agents' step methods
+    self.agent_seconds = 0.0
+
+  # Microseconds since the profiler was created, for the trace
+  def timestamp(self, time):
+    return 1e6 * (time - self.start)
+
+  # Time a phase of the model's step, adding it to the phase's total and to
+  # the trace
+  @contextmanager
+  def phase(self, name):
+    start = perf_counter()
+    try:
+      yield
+    finally:
+      end = perf_counter()
+      self.times[name] += end - start
+      if self.trace:
+        self.trace_events.append({"name":name, "ph":"X", "pid":0, "tid":0,
+                                  "ts":self.timestamp(start), "dur":1e6 * (end - start)})
+
+  # Run one step of the model, timing each phase
+  def step(self, model):
+    self.start_step()
+    step_start = perf_counter()
+    with self.phase("schedule"):
+      model.schedule.step()
+    # The scheduler's own time is what it spent outside the agents' steps
+    self.times["schedule"] -= self.agent_seconds
+    if model.debug:
+      with self.phase("checks"):
+        model.check_tallies()
+        model.check_index()
+    with self.phase("collect"):
+      model.datacollector.collect(model)
+    with self.phase("termination"):
+      model.check_termination()
+    self.end_step(model, step_start)
+
+  # Record the step's times and counts in the Profile table and the trace
+  def end_step(self, model, step_start):
+    end = perf_counter()
+    if self.trace:
+      self.trace_events.append({"name":"step {}".format(model.schedule.steps), "ph":"X", "pid":0, "tid":0,
+                                "ts":self.timestamp(step_start), "dur":1e6 * (end - step_start)})
+      self.trace_events.append({"name":"agent phases (ms)", "ph":"C", "pid":0, "ts":self.timestamp(end),
+                                "args":{name:1e3 * self.times[name] for name in AGENT_PHASES}})
+      self.trace_events.append({"name":"events", "ph":"C", "pid":0, "ts":self.timestamp(end),
+                                "args":dict(self.counts)})
+
+    row = {"Step":model.schedule.steps}
+    row.update({column:self.times[name] for name, column in PHASES.items()})
+    row.update({column:self.counts[name] for name, column in EVENTS.items()})
+    model.datacollector.add_table_row("Profile", row)
+
+  # Write the trace of every step so far to path, as Chrome trace event JSON
+  def export_trace(self, path):
+    if not self.trace:
+      raise ValueError('No trace was kept; create the model with profile="trace" to keep one')
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+      json.dump({"traceEvents":self.trace_events, "displayTimeUnit":"ms"}, f)
+    os.replace(temp_path, path)
@@ -0,0 +1,97 @@
+import math
+import sys
+
+import numpy as np
+
+# Random number streams owned by a model, in place of the global random
+# module. Each stream is a NumPy generator seeded from its own branch of a
+# SeedSequence, so streams spawned from one seed are independent of each
+# other but the same seed always gives the same numbers. Numbers are drawn
+# from the generator in blocks and handed out one at a time, so the hot
+# paths in the agents' step functions don't need a NumPy call per draw.
+
+
+# Spawn n independent seed sequences from a single seed (or SeedSequence),
+# e.g. one per replica of a model or one per agent class within a model
+def spawn_seeds(seed, n):
+  if not isinstance(seed, np.random.SeedSequence):
+    seed = np.random.SeedSequence(seed)
+  return seed.spawn(n)
+
+
+class Random_Stream:
+  # Offers the parts of the random.Random interface used by the model and by
+  # mesa (random, uniform, randint, randrange, choice, expovariate, shuffle)
+  def __init__(self, seed, block_size=4096):
+    self.generator = np.random.default_rng(seed)
+    self.block_size = block_size
+    # Iterator over the current block of uniform numbers; starts empty so
+    # the first draw fetches a block
+    self.next_uniform = iter(()).__next__
+
+  # Uniform number in [0, 1)
+  def random(self):
+    try:
+      return self.next_uniform()
+    except StopIteration:
+      self.next_uniform = iter(self.generator.random(self.block_size).tolist()).__next__
+      return self.next_uniform()
+
+  def uniform(self, a, b):
+    return a + (b - a) * self.random()
+
+  # Integer from a to b inclusive, like random.randint
+  def randint(self, a, b):
+    return a + int(self.random() * (b - a + 1))
+
+  # Integer from 0 to n - 1, like random.randrange(n)
+  def randrange(self, n):
+    return int(self.random() * n)
+
+  def choice(self, seq):
+    return seq[int(self.random() * len(seq))]
+
+  def expovariate(self, lambd):
+    return -math.log(1.0 - self.random()) / lambd
+
+  # The stream's state - the generator's state and the uniform numbers drawn
+  # from it but not yet handed out - so it can be saved and carried on from
+  # later with set_state
+  def get_state(self):
+    remaining = list(self.next_uniform.__self__)
+    self.next_uniform = iter(remaining).__next__
+    return {"generator":self.generator.bit_generator.state, "block":remaining}
+
+  def set_state(self, state):
+    self.generator.bit_generator.state = state["generator"]
+    self.next_uniform = iter(list(state["block"])).__next__
+
+  # Shuffle a list in place (used by mesa's RandomActivation scheduler). The
+  # whole permutation is drawn in one call rather than one draw per item.
+  def shuffle(self, seq):
+    seq[:] = [seq[i] for i in self.generator.permutation(len(seq))]
+
+
+# Check that the same seed gives the same run: two models with the same
+# seed must collect exactly the same data, and one with a different seed
+# different data (or the seed isn't being used at all). Run this file to
+# check it, exiting with status 1 if not.
+def check_same_seed(steps=50, seed=0, **params):
+  from disease_model import Disease_Model
+  from disease_sweep import slider_defaults
+  params = dict(slider_defaults(), **params)
+
+  def run(seed):
+    model = Disease_Model(**params, seed=seed)
+    for i in range(steps):
+      model.step()
+    return model.datacollector.get_model_vars_dataframe()
+
+  results = run(seed)
+  return results.equals(run(seed)) and not results.equals(run(seed + 1))
+
+
+if __name__ == "__main__":
+  same = check_same_seed()
+  print("OK" if same else "DIFFERENT")
+  sys.exit(0 if same else 1)
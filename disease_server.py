@@ -3,14 +3,16 @@
 from disease_model import Disease_Model
 # This will import the type of grid we want to visualise our agents
 from mesa.visualization.modules import CanvasGrid
-# This will import the ModularServer class, which allows us to create a new 
-# server to host the visualisation of our model
-from mesa.visualization.ModularVisualization import ModularServer
 # This will import to ModularServer class, which allows us to create a new
 # server to host the visualisation of our model
 from mesa.visualization.UserParam import UserSettableParameter
 # (below) Lastly, we add the ChartModule(used for drawing graphs)
 from mesa.visualization.modules import ChartModule
+# And the heatmap of compartment counts per cell, for large grids and
+# populations
+from disease_heatmap import Compartment_Heatmap
+# The server that steps the model in the background, ahead of the browser
+from disease_playback import Playback_Server
 
 # Portrayal function that defines how agents will be drawn onto the grid
 # We specify that the function takes an agent as its input - it wil draw the
@@ -78,6 +80,13 @@ def agent_portrayal(agent):
 # function we defined, has 20 x 20 cells, and a display size of 700x700 pixels
 grid = CanvasGrid(agent_portrayal,20,20,700,700)
 
+# For large grids or populations, drawing every agent gets too slow - set
+# HEATMAP to True to draw a heatmap of how many agents in each compartment
+# are in each cell instead (change its width and height along with the
+# model's below)
+HEATMAP = False
+heatmap = Compartment_Heatmap(20,20,700,700)
+
 
 # Set up a chart to represent the totals of each population over time. We instantiate a 
 # ChartModule for this, and pass in a dictionary containing the label for the
@@ -106,16 +115,19 @@ treatment_length_slider = UserSettableParameter('slider', "Length of Treatment/I
 isolation_slider = UserSettableParameter('slider', "Chance of Exposed Human Being Placed in Isolation", 60, 1, 100, 1)
 environmental_slider = UserSettableParameter('slider', "Environmental Control (Rodents Chance of Not Moving)", 0, 0, 50, 1)
 pesticide_slider = UserSettableParameter('slider', "Pesticide Control (Rodents Chance of Dying)", 0, 0, 50, 1)
+# How many steps the model runs for each frame drawn in the browser
+steps_per_frame_slider = UserSettableParameter('slider', "Steps per Frame", 1, 1, 50, 1)
 
 
-# Set up the server as a ModularServer, passing in the model class we
+# Set up the server as a Playback_Server (a ModularServer that steps the model
+# in the background), passing in the model class we
 # imported earlier, the list of elements we want to visualise (just the grid
 # here), the title to display for the server visualisation, and each user
 # interface we want to incluide (our  sliders here) in a dictionary, where the
 # index name in " marks must match the respective variable name in the Model
 # class, and the lookup value is the name of the slider we declared above
 # (ie "name_of_variable":name_of_slider)
-server = ModularServer(Disease_Model, [grid, total_graph],  "Lassa Fever Spread Model",
+server = Playback_Server(Disease_Model, [heatmap if HEATMAP else grid, total_graph],  "Lassa Fever Spread Model",
                       {"N":number_of_agents_slider, "width":20, "height":20,
                        "initial_infection":initial_infection_slider,
                        "transmissibility":transmissibility_slider,
@@ -126,7 +138,13 @@ server = ModularServer(Disease_Model, [grid, total_graph],  "Lassa Fever Spread
                        "treatment_length":treatment_length_slider,
                        "isolation":isolation_slider,
                        "environmental":environmental_slider,
-                       "pesticide":pesticide_slider
+                       "pesticide":pesticide_slider,
+                       # keep dead rodents on the grid so they're drawn in gray
+                       "prune_dead":False,
+                       # stop the run once the disease has died out
+                       "stop_on_extinction":True,
+                       # steps per frame drawn (not passed to the model)
+                       "steps_per_frame":steps_per_frame_slider
                        }
                       )
 
@@ -0,0 +1,404 @@
+import functools
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+from mesa import Model
+from mesa.datacollection import DataCollector
+
+from disease_compare import compare_models, report_comparison
+from disease_model import MOORE_DX, MOORE_DY, Termination_Criteria
+from disease_timers import Timer_Wheel
+from disease_vectorized import Vectorized_Disease_Model
+
+# A version of Vectorized_Disease_Model for grids too big to step in one
+# process. The torus is cut into strips of whole columns, and each strip
+# (a shard) is run by a worker process of its own, which holds the state of
+# the agents currently on its columns and steps them with the same rules as
+# Vectorized_Disease_Model.
+#
+# Agents only ever meet others in the same cell, and move at most one cell a
+# step, so all a shard needs to know about its neighbours is which cells
+# near the edge between them hold infected rodents:
+#   - each time infected rodents expose humans (once per activation slot),
+#     the two shards either side of an edge swap which cells in the columns
+#     either side of it hold infected rodents (the halo), through shared
+#     memory, so that a rodent that has just stepped over the edge still
+#     exposes the humans on the other side of it
+#   - at the end of each step, agents that have stepped onto a neighbour's
+#     columns are handed over (migrated) to it
+# The main process only tells the shards when to step, and adds up the
+# counts they report to collect the model's data.
+#
+# Every shard draws its own random numbers, so a run gives the same results
+# for the same seed and number of shards, but not the same results as
+# Vectorized_Disease_Model or a run with a different number of shards (they
+# are statistically equivalent - see compare_with_vectorized_model).
+
+# Agent state arrays moved with an agent when it changes shard
+HUMAN_STATE = ("human_pos", "human_infected", "human_susceptible", "human_exposed", "human_removed",
+               "human_recovery_step", "human_removed_since", "human_isolation_used")
+RODENT_STATE = ("rodent_pos", "rodent_infected", "rodent_susceptible", "rodent_death", "rodent_recovery_step")
+
+# Parameters a shard needs from the model
+SHARD_PARAMS = ("width", "height", "transmissibility", "level_of_movement", "mean_length_of_disease",
+                "treatment_chance", "treatment_length", "isolation", "environmental", "pesticide",
+                "activation_slots")
+
+# Stop waiting for a step of the shards after this many seconds (something
+# has gone badly wrong with one of them)
+SHARD_TIMEOUT = 600
+
+
+class Model_Shard(Vectorized_Disease_Model):
+  # index is this shard's number, and its columns run from bounds[index] up
+  # to bounds[index + 1]. humans and rodents hold the state (as in
+  # HUMAN_STATE and RODENT_STATE) of the agents starting on its columns.
+  # halo is a shared array of shape (shards, 2 edges, 2, 2 * height), or
+  # None if there's only one shard.
+  def __init__(self, index, bounds, params, seed, humans, rodents, halo, barrier, inboxes):
+    for name in SHARD_PARAMS:
+      setattr(self, name, params[name])
+    self.index = index
+    self.first_column = bounds[index]
+    self.columns = bounds[index + 1] - bounds[index]
+    self.num_shards = len(bounds) - 1
+    self.rng = np.random.default_rng(seed)
+    self.steps = 0
+    self.halo = halo
+    self.barrier = barrier
+    self.inboxes = inboxes
+    self.exchanges = 0
+
+    for name in HUMAN_STATE:
+      setattr(self, name, humans[name])
+    for name in RODENT_STATE:
+      setattr(self, name, rodents[name])
+    self.num_humans = self.human_pos.size
+    self.num_rodents = self.rodent_pos.size
+    self.human_timers = Timer_Wheel()
+    self.rodent_timers = Timer_Wheel()
+    infected = np.flatnonzero(self.rodent_infected)
+    self.rodent_recovery_step[infected] = self.recovery_steps(0, self.disease_lengths(infected.size))
+    self.rodent_timers.schedule(infected, self.rodent_recovery_step[infected])
+
+  # How far to the right of this shard's first column each of the given
+  # cells is (wrapping around the grid)
+  def column_offsets(self, cells):
+    return (cells // self.height - self.first_column) % self.width
+
+  # Index of each of the given cells in an array covering this shard's
+  # columns plus one column either side
+  def local_cells(self, cells):
+    return ((self.column_offsets(cells) + 1) % self.width) * self.height + cells % self.height
+
+  # As Vectorized_Disease_Model.move, working the neighbours out rather than
+  # looking them up, so no shard needs a table covering the whole grid
+  def move(self, cells):
+    choice = self.rng.integers(0, MOORE_DX.size, cells.size)
+    x, y = np.divmod(cells, self.height)
+    return (x + MOORE_DX[choice]) % self.width * self.height + (y + MOORE_DY[choice]) % self.height
+
+  # As Vectorized_Disease_Model.expose, adding in the infected rodents the
+  # neighbouring shards have near the edges of this one. Every shard calls
+  # this once in every activation slot, whether or not it has any infected
+  # rodents, so that they all meet at the barrier.
+  def expose(self, infected):
+    edge = 2 * self.height # the column either side of an edge
+    infected_cells = np.zeros((self.columns + 2) * self.height, dtype=bool)
+    infected_cells[self.local_cells(self.rodent_pos[infected])] = True
+    if self.halo is not None:
+      # Alternate between two halo buffers, so a shard that's gone on to the
+      # next slot can't overwrite one its neighbour is still reading
+      buffer = self.exchanges % 2
+      self.exchanges += 1
+      self.halo[self.index, 0, buffer] = infected_cells[:edge]
+      self.halo[self.index, 1, buffer] = infected_cells[-edge:]
+      self.barrier.wait()
+      infected_cells[:edge] |= self.halo[(self.index - 1) % self.num_shards, 1, buffer]
+      infected_cells[-edge:] |= self.halo[(self.index + 1) % self.num_shards, 0, buffer]
+    if infected_cells.any():
+      exposed = infected_cells[self.local_cells(self.human_pos)] & ~self.human_infected
+      self.human_exposed[exposed] = True
+      self.human_susceptible[exposed] = False
+
+  def step(self):
+    self.step_agents(np.arange(self.num_humans), np.flatnonzero(~self.rodent_death))
+    self.steps += 1
+    self.migrate()
+
+  # Hand the agents that have stepped off this shard's columns to the
+  # neighbour they stepped onto, and take in those handed over to it
+  def migrate(self):
+    if self.halo is None:
+      return
+    human_offsets = self.column_offsets(self.human_pos)
+    rodent_offsets = self.column_offsets(self.rodent_pos)
+    left = (self.index - 1) % self.num_shards
+    right = (self.index + 1) % self.num_shards
+    # Each hand-over is labelled with the side of the neighbour it arrives
+    # from (0 = left, 1 = right)
+    for neighbour, offset, side in ((left, self.width - 1, 1), (right, self.columns, 0)):
+      self.inboxes[neighbour].put((side,
+                                   {name:getattr(self, name)[human_offsets == offset] for name in HUMAN_STATE},
+                                   {name:getattr(self, name)[rodent_offsets == offset] for name in RODENT_STATE}))
+    self.keep(HUMAN_STATE, human_offsets < self.columns, self.human_timers)
+    self.keep(RODENT_STATE, rodent_offsets < self.columns, self.rodent_timers)
+
+    # One hand-over from each side (with two shards, both from the same one).
+    # They're taken in the same order whichever arrives first, so the
+    # results don't depend on the timing of the processes.
+    handed_over = [self.inboxes[self.index].get(timeout=SHARD_TIMEOUT) for i in range(2)]
+    if None in handed_over:
+      raise RuntimeError("A neighbouring shard failed")
+    for side, humans, rodents in sorted(handed_over, key=lambda message: message[0]):
+      self.arrive(HUMAN_STATE, humans, self.human_timers, "human_infected", "human_recovery_step")
+      self.arrive(RODENT_STATE, rodents, self.rodent_timers, "rodent_infected", "rodent_recovery_step")
+    self.num_humans = self.human_pos.size
+    self.num_rodents = self.rodent_pos.size
+
+  # Keep only the agents where kept is True in the given state arrays
+  def keep(self, names, kept, timers):
+    new_index = np.full(kept.size, -1)
+    new_index[kept] = np.arange(np.count_nonzero(kept))
+    timers.renumber(new_index)
+    for name in names:
+      setattr(self, name, getattr(self, name)[kept])
+
+  # Add agents handed over by another shard to the given state arrays,
+  # setting timers for the infected ones
+  def arrive(self, names, state, timers, infected, recovery_step):
+    start = getattr(self, names[0]).size
+    for name in names:
+      setattr(self, name, np.concatenate([getattr(self, name), state[name]]))
+    arrived = start + np.flatnonzero(state[infected])
+    timers.schedule(arrived, getattr(self, recovery_step)[arrived])
+
+  # This shard's share of the model's counts, plus its infected rodents
+  def counts(self):
+    return np.array([np.count_nonzero(self.human_infected), np.count_nonzero(self.human_susceptible),
+                     np.count_nonzero(self.rodent_death), np.count_nonzero(self.human_exposed),
+                     np.count_nonzero(self.human_removed), np.count_nonzero(self.rodent_infected)])
+
+
+# The worker process for one shard: steps it whenever the main process says
+# to, replying with its counts (or the error, if it fails)
+def run_shard(index, bounds, params, seed, humans, rodents, halo_name, barrier, inboxes, connection):
+  halo_memory = None
+  try:
+    halo = None
+    if halo_name is not None:
+      halo_memory = shared_memory.SharedMemory(name=halo_name)
+      halo = np.ndarray((len(bounds) - 1, 2, 2, 2 * params["height"]), dtype=bool, buffer=halo_memory.buf)
+    shard = Model_Shard(index, bounds, params, seed, humans, rodents, halo, barrier, inboxes)
+    while connection.recv() == "step":
+      shard.step()
+      connection.send(shard.counts())
+  except Exception:
+    # Don't leave the other shards waiting for this one
+    barrier.abort()
+    for inbox in inboxes:
+      inbox.put(None)
+    connection.send(traceback.format_exc())
+  finally:
+    halo = shard = None
+    if halo_memory is not None:
+      halo_memory.close()
+
+
+# Tell the shards' processes to finish, and free the shared memory
+def stop_shards(processes, connections, memories):
+  for connection in connections:
+    try:
+      connection.send("stop")
+    except (BrokenPipeError, OSError):
+      pass
+  for process in processes:
+    process.join(5)
+    if process.is_alive():
+      process.terminate()
+  for memory in memories:
+    memory.close()
+    memory.unlink()
+
+
+class Sharded_Disease_Model(Model):
+  """A model of how Lassa Fever spreads, with the grid split into strips that are each stepped by a process of their own, for very large grids."""
+  def __init__(self, N, width, height, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, rodent_population, treatment_chance, treatment_length, isolation, environmental, pesticide, seed=None, shards=None, activation_slots=4, stop_on_extinction=False, stable_steps=None, max_steps=None):
+    self.running = True # required for BatchRunner
+    self.num_humans = N
+    self.num_rodents = rodent_population
+    self.width = width
+    self.height = height
+    self.num_cells = width * height
+    self.steps = 0
+
+    # Each strip must be at least two columns wide, so the columns either
+    # side of one of its edges never overlap with those of the other
+    self.num_shards = max(1, min(shards or os.cpu_count(), width // 2))
+    self.bounds = np.arange(self.num_shards + 1) * width // self.num_shards
+
+    self.termination = Termination_Criteria(stop_on_extinction, stable_steps, max_steps)
+    self.stop_reason = None
+    self.stop_step = None
+
+    # Place the agents on the whole grid as Vectorized_Disease_Model does
+    # (distinct cells while there are any left), then give each shard the
+    # agents on its columns
+    seeds = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seeds.spawn(1)[0])
+    n = N + rodent_population
+    start_cells = rng.choice(self.num_cells, min(n, self.num_cells), replace=False)
+    if n > self.num_cells:
+      start_cells = np.concatenate([start_cells, rng.integers(0, self.num_cells, n - self.num_cells)])
+    human_pos = start_cells[:N]
+    rodent_pos = start_cells[N:]
+    rodent_infected = rng.random(rodent_population) < initial_infection
+    human_shard = np.searchsorted(self.bounds, human_pos // height, side="right") - 1
+    rodent_shard = np.searchsorted(self.bounds, rodent_pos // height, side="right") - 1
+
+    params = dict(width=width, height=height, transmissibility=transmissibility, level_of_movement=level_of_movement,
+                  mean_length_of_disease=mean_length_of_disease, treatment_chance=treatment_chance,
+                  treatment_length=treatment_length, isolation=isolation, environmental=environmental,
+                  pesticide=pesticide, activation_slots=activation_slots)
+    memories = []
+    halo_name = None
+    if self.num_shards > 1:
+      halo_memory = shared_memory.SharedMemory(create=True, size=self.num_shards * 2 * 2 * 2 * height)
+      memories.append(halo_memory)
+      halo_name = halo_memory.name
+    barrier = multiprocessing.Barrier(self.num_shards)
+    inboxes = [multiprocessing.Queue() for shard in range(self.num_shards)]
+    self.connections = []
+    processes = []
+    for shard, shard_seed in enumerate(seeds.spawn(self.num_shards)):
+      humans = human_pos[human_shard == shard]
+      count = humans.size
+      humans = {"human_pos":humans, "human_infected":np.zeros(count, dtype=bool),
+                "human_susceptible":np.ones(count, dtype=bool), "human_exposed":np.zeros(count, dtype=bool),
+                "human_removed":np.zeros(count, dtype=bool), "human_recovery_step":np.zeros(count, dtype=np.int64),
+                "human_removed_since":np.zeros(count, dtype=np.int64),
+                "human_isolation_used":np.zeros(count, dtype=np.int64)}
+      infected = rodent_infected[rodent_shard == shard]
+      rodents = {"rodent_pos":rodent_pos[rodent_shard == shard], "rodent_infected":infected,
+                 "rodent_susceptible":~infected, "rodent_death":np.zeros(infected.size, dtype=bool),
+                 "rodent_recovery_step":np.zeros(infected.size, dtype=np.int64)}
+      connection, shard_connection = multiprocessing.Pipe()
+      process = multiprocessing.Process(target=run_shard, daemon=True,
+                                        args=(shard, self.bounds, params, shard_seed, humans, rodents, halo_name,
+                                              barrier, inboxes, shard_connection))
+      process.start()
+      self.connections.append(connection)
+      processes.append(process)
+    self.finalizer = weakref.finalize(self, stop_shards, processes, self.connections, memories)
+
+    # The model's counts, added up over the shards after each step
+    self.totals = np.zeros(6, dtype=np.int64)
+    self.totals[1] = N
+    self.totals[5] = np.count_nonzero(rodent_infected)
+
+    self.datacollector = DataCollector(
+      model_reporters={"Infected Humans":calculate_number_infected,
+                       "Susceptible Humans":calculate_number_susceptible,
+                       "Deceased Rodents":calculate_number_deceased,
+                       "Exposed Humans":calculate_number_exposed,
+                       "Removed/Recovered/Isolated Humans":calculate_number_removed},
+      agent_reporters={},
+      tables={"Termination":["Stop Reason", "Stop Step"]}
+      )
+
+  # Function to advance the model by one step
+  def step(self):
+    for connection in self.connections:
+      try:
+        connection.send("step")
+      except OSError:
+        pass # the shard has stopped, and its error is waiting to be read below
+    replies = []
+    for connection in self.connections:
+      if not connection.poll(SHARD_TIMEOUT):
+        self.close()
+        raise RuntimeError("Timed out waiting for a shard")
+      try:
+        replies.append(connection.recv())
+      except EOFError:
+        replies.append("A shard's process stopped without saying why")
+    errors = [reply for reply in replies if isinstance(reply, str)]
+    if errors:
+      self.close()
+      raise RuntimeError("A shard failed:\n" + errors[0])
+    self.totals = np.sum(replies, axis=0)
+    self.steps += 1
+    self.datacollector.collect(self)
+
+    counts = (calculate_number_infected(self), calculate_number_susceptible(self), calculate_number_deceased(self),
+              calculate_number_exposed(self), calculate_number_removed(self))
+    self.termination.update(self, self.steps, counts, int(self.totals[5]))
+
+  # Stop the shards' processes. The model can't be stepped after this; it's
+  # also done when the model is garbage collected.
+  def close(self):
+    self.finalizer()
+
+# Model reporters - the totals of the shards' counts
+def calculate_number_infected(model):
+  return int(model.totals[0])
+
+def calculate_number_susceptible(model):
+  return int(model.totals[1])
+
+def calculate_number_deceased(model):
+  return int(model.totals[2])
+
+def calculate_number_exposed(model):
+  return int(model.totals[3])
+
+def calculate_number_removed(model):
+  return int(model.totals[4])
+
+
+# Statistical equivalence check against Vectorized_Disease_Model (see
+# compare_models in disease_compare.py). Run this file to check it, exiting
+# with status 1 if any series differs.
+def compare_with_vectorized_model(replicas=50, steps=100, tolerance=0.01, seed=0, shards=4, **params):
+  model_params = {"N":400, "width":40, "height":20, "initial_infection":0.9,
+                  "transmissibility":1, "level_of_movement":0.56,
+                  "mean_length_of_disease":18, "rodent_population":400,
+                  "treatment_chance":35, "treatment_length":40, "isolation":60,
+                  "environmental":0, "pesticide":0}
+  model_params.update(params)
+  return compare_models(Vectorized_Disease_Model, functools.partial(Sharded_Disease_Model, shards=shards),
+                        model_params, replicas, steps, tolerance, seed)
+
+
+# Steps per second on a large grid with each of the given numbers of shards
+def measure_scaling(shard_counts=None, steps=20, seed=0, **params):
+  model_params = {"N":1000000, "width":2000, "height":2000, "initial_infection":0.3,
+                  "transmissibility":0.8, "level_of_movement":0.56,
+                  "mean_length_of_disease":18, "rodent_population":1000000,
+                  "treatment_chance":35, "treatment_length":40, "isolation":60,
+                  "environmental":0, "pesticide":0}
+  model_params.update(params)
+  if shard_counts is None:
+    shard_counts = sorted({1, 2, 4, os.cpu_count()})
+  results = {}
+  for shards in shard_counts:
+    model = Sharded_Disease_Model(**model_params, seed=seed, shards=shards)
+    start = time.perf_counter()
+    for i in range(steps):
+      model.step()
+    results[model.num_shards] = steps / (time.perf_counter() - start)
+    model.close()
+  return results
+
+
+if __name__ == "__main__":
+  status = report_comparison(compare_with_vectorized_model())
+  for shards, rate in measure_scaling().items():
+    print("{} shard(s): {:.2f} steps/s".format(shards, rate))
+  sys.exit(status)
@@ -0,0 +1,377 @@
+# A fast stand-in for Disease_Model, for screening many interventions before
+# running the promising ones in the full model. Rather than following every
+# agent around the grid, it only keeps count of how many humans and rodents
+# are in each compartment, and treats the population as well mixed: each
+# step, a human who can be exposed is exposed at a rate proportional to the
+# number of active infected rodents per cell. Every other rate comes from
+# the same parameters and rules as Human_Agent.step and Rodent_Agent.step.
+#
+# The effect of space (how often humans and infected rodents actually share
+# a cell, which depends on movement) is summed up in a contact rate, and how
+# quickly an exposure is resolved in a resolution rate. calibrate fits both
+# to short runs of Disease_Model.
+#
+# Three ways of running it:
+#   "gillespie"  - exact stochastic simulation, one event at a time
+#   "tau_leap"   - stochastic, with all the events in each short interval
+#                  (tau) drawn at once; much faster for large populations
+#   "mean_field" - the expected counts, with no randomness
+#
+# Example - screen pesticide and treatment chance, after calibrating:
+#   python3 disease_surrogate.py --calibrate --param pesticide=0:50:5 --param treatment_chance=10:90:10 --out screen.csv
+import argparse
+import itertools
+import math
+
+import numpy as np
+import pandas as pd
+from mesa import Model
+from mesa.datacollection import DataCollector
+
+from disease_model import Termination_Criteria
+
+# Compartments. Humans can carry more than one of the agent model's
+# compartment flags at once (e.g. a removed human who is exposed again stays
+# removed), so some compartments here stand for a combination of flags.
+S = 0   # susceptible human
+SR = 1  # susceptible and removed (a removed human who was exposed but not infected)
+E = 2   # exposed human
+ER = 3  # exposed and removed
+I = 4   # infected human
+IR = 5  # infected and removed (treated after being infected)
+R = 6   # removed human
+RI = 7  # infected rodent
+RS = 8  # susceptible rodent
+RD = 9  # dead rodent
+NUM_COMPARTMENTS = 10
+
+# The reactions between compartments: (from, to)
+REACTIONS = [(S, E), (R, ER), (SR, ER),                 # exposure
+             (E, R), (E, I), (E, IR), (E, S),           # resolving an exposure
+             (ER, R), (ER, I), (ER, IR), (ER, SR),
+             (I, R), (IR, R),                           # humans recovering
+             (RI, RS),                                  # rodents recovering
+             (RI, RD), (RS, RD)]                        # pesticide
+NUM_REACTIONS = len(REACTIONS)
+SOURCES = np.array([source for source, target in REACTIONS])
+CHANGES = np.zeros((NUM_REACTIONS, NUM_COMPARTMENTS), dtype=np.int64)
+for reaction, (source, target) in enumerate(REACTIONS):
+  CHANGES[reaction, source] -= 1
+  CHANGES[reaction, target] += 1
+# The reactions out of each compartment that has any
+OUT_OF = [(source, np.flatnonzero(SOURCES == source)) for source in np.unique(SOURCES)]
+# Exposures happen at a rate proportional to the number of infected rodents
+EXPOSURES = np.isin(np.arange(NUM_REACTIONS), [0, 1, 2])
+
+
+# Chance of random.randint(0, 100) < chance, as used in the agent model
+def percent_probability(chance):
+  return min(max(chance, 0), 101) / 101
+
+# The constant rate of an event that happens with probability p each step
+def hazard(p):
+  return -math.log(1 - min(p, 1 - 1e-9))
+
+
+# Rate of each reaction per member of its source compartment (and, for
+# exposures, per infected rodent) from the model parameters. Every other rate
+# comes from the same rules as Human_Agent.step and Rodent_Agent.step.
+def rate_constants(width, height, transmissibility, mean_length_of_disease, treatment_chance, environmental, pesticide,
+                   contact_rate=1.0, resolution_rate=2.0):
+  treated = percent_probability(treatment_chance)
+  active = 1 - percent_probability(environmental) # rodents not held back
+  exposure = contact_rate * active / (width * height)
+  recovery = 1 / mean_length_of_disease
+  killed = hazard(percent_probability(pesticide))
+  # Outcome of resolving an exposure (treated, infected or back to
+  # susceptible, then a second chance of treatment), as in Human_Agent.step
+  resolved = resolution_rate * np.array([treated + (1 - treated) * (1 - transmissibility) * treated,
+                                         (1 - treated) * transmissibility * (1 - treated),
+                                         (1 - treated) * transmissibility * treated,
+                                         (1 - treated) * (1 - transmissibility) * (1 - treated)])
+  return np.concatenate([[exposure] * 3, resolved, resolved, [recovery, recovery, active * recovery, killed, killed]])
+
+
+# Rate of each reaction per member of its source compartment, for counts of
+# shape (..., compartments) and constants of shape (..., reactions)
+def per_capita_rates(counts, constants):
+  return constants * np.where(EXPOSURES, counts[..., RI:RI + 1], 1)
+
+
+# Advance counts (one row per run) by an interval tau, with the rates held
+# fixed over it. The number leaving each compartment is binomial (so a
+# compartment can never go negative), and those leaving are split between
+# the reactions out of it in proportion to their rates, by drawing each
+# reaction's share of what the reactions before it left over. Without a rng,
+# the expected numbers are used instead (the mean field).
+def leap(counts, constants, tau, rng=None):
+  rates = per_capita_rates(counts, constants)
+  exit_rates = np.zeros(counts.shape)
+  for source, reactions in OUT_OF:
+    exit_rates[..., source] = rates[..., reactions].sum(axis=-1)
+  leave_probability = 1 - np.exp(-exit_rates * tau)
+  if rng is None:
+    leaving = counts * leave_probability
+  else:
+    leaving = rng.binomial(counts, leave_probability)
+  fired = np.zeros(rates.shape, dtype=leaving.dtype)
+  for source, reactions in OUT_OF:
+    shares = rates[..., reactions] / np.maximum(exit_rates[..., source:source + 1], 1e-300)
+    if rng is None:
+      fired[..., reactions] = leaving[..., source:source + 1] * shares
+      continue
+    remaining = leaving[..., source]
+    share_left = np.ones(remaining.shape)
+    for k, reaction in enumerate(reactions[:-1]):
+      p = np.clip(shares[..., k] / np.maximum(share_left, 1e-300), 0, 1)
+      fired[..., reaction] = rng.binomial(remaining, p)
+      remaining = remaining - fired[..., reaction]
+      share_left = share_left - shares[..., k]
+    fired[..., reactions[-1]] = remaining
+  return counts + fired @ CHANGES
+
+
+# Starting counts: as in Rodent_Agent, each rodent starts infected with
+# probability initial_infection; every human starts susceptible. Without a
+# rng, the expected counts. Given arrays of parameters, one row of counts per
+# run.
+def initial_counts(N, rodent_population, initial_infection, rng=None):
+  shape = np.broadcast(N, rodent_population, initial_infection).shape
+  counts = np.zeros(shape + (NUM_COMPARTMENTS,), dtype=float if rng is None else np.int64)
+  if rng is None:
+    counts[..., RI] = np.multiply(rodent_population, initial_infection)
+  else:
+    counts[..., RI] = rng.binomial(rodent_population, initial_infection, size=shape)
+  counts[..., RS] = rodent_population - counts[..., RI]
+  counts[..., S] = N
+  return counts
+
+
+class Surrogate_Model(Model):
+  """A well-mixed stochastic compartmental approximation of the Lassa Fever model, for quickly screening interventions."""
+  # level_of_movement, treatment_length and isolation are accepted so the
+  # surrogate takes the same parameters as Disease_Model, but don't appear
+  # in its rates (movement is summed up in contact_rate, and the other two
+  # don't affect any of the five reported series)
+  def __init__(self, N, width, height, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, rodent_population, treatment_chance, treatment_length, isolation, environmental, pesticide, seed=None, method="tau_leap", tau=0.25, contact_rate=1.0, resolution_rate=2.0, stop_on_extinction=False, stable_steps=None, max_steps=None):
+    if method not in ("gillespie", "tau_leap", "mean_field"):
+      raise ValueError("Unknown method {!r}".format(method))
+    self.running = True
+    self.num_humans = N
+    self.num_rodents = rodent_population
+    self.method = method
+    self.tau = tau
+    self.rng = np.random.default_rng(seed)
+    self.steps = 0
+    self.constants = rate_constants(width, height, transmissibility, mean_length_of_disease, treatment_chance,
+                                    environmental, pesticide, contact_rate, resolution_rate)
+
+    self.termination = Termination_Criteria(stop_on_extinction, stable_steps, max_steps)
+    self.stop_reason = None
+    self.stop_step = None
+
+    self.counts = initial_counts(N, rodent_population, initial_infection, None if method == "mean_field" else self.rng)
+
+    self.datacollector = DataCollector(
+      model_reporters={"Infected Humans":calculate_number_infected,
+                       "Susceptible Humans":calculate_number_susceptible,
+                       "Deceased Rodents":calculate_number_deceased,
+                       "Exposed Humans":calculate_number_exposed,
+                       "Removed/Recovered/Isolated Humans":calculate_number_removed},
+      agent_reporters={},
+      tables={"Termination":["Stop Reason", "Stop Step"]}
+      )
+
+  # Advance by one step using Gillespie's direct method: draw the time to
+  # the next event and which event it is, one event at a time. An event that
+  # would happen after the end of the step is dropped (the process has no
+  # memory, so drawing again from the end of the step is equivalent).
+  def advance_gillespie(self):
+    time = 0.0
+    while True:
+      rates = per_capita_rates(self.counts, self.constants) * self.counts[SOURCES]
+      total = rates.sum()
+      if total <= 0:
+        return
+      time += self.rng.exponential(1 / total)
+      if time >= 1:
+        return
+      reaction = int(np.searchsorted(np.cumsum(rates), self.rng.random() * total, side="right"))
+      self.counts += CHANGES[min(reaction, NUM_REACTIONS - 1)]
+
+  # Advance by one step in intervals of (about) tau
+  def advance_tau_leap(self, mean_field=False):
+    intervals = max(1, int(round(1 / self.tau)))
+    for i in range(intervals):
+      self.counts = leap(self.counts, self.constants, 1 / intervals, None if mean_field else self.rng)
+
+  def step(self):
+    if self.method == "gillespie":
+      self.advance_gillespie()
+    else:
+      self.advance_tau_leap(self.method == "mean_field")
+    self.steps += 1
+    self.datacollector.collect(self)
+
+    counts = (calculate_number_infected(self), calculate_number_susceptible(self), calculate_number_deceased(self),
+              calculate_number_exposed(self), calculate_number_removed(self))
+    # Less than half an infected rodent counts as none in the mean field
+    self.termination.update(self, self.steps, counts, int(round(self.counts[RI])))
+
+# Model reporters - the same five series as Disease_Model's, added up from the
+# compartments each flag appears in
+def calculate_number_infected(model):
+  return model.counts[I] + model.counts[IR]
+
+def calculate_number_susceptible(model):
+  return model.counts[S] + model.counts[SR]
+
+def calculate_number_deceased(model):
+  return model.counts[RD]
+
+def calculate_number_exposed(model):
+  return model.counts[E] + model.counts[ER]
+
+def calculate_number_removed(model):
+  return model.counts[R] + model.counts[SR] + model.counts[ER] + model.counts[IR]
+
+
+SERIES = ["Infected Humans", "Susceptible Humans", "Deceased Rodents", "Exposed Humans",
+          "Removed/Recovered/Isolated Humans"]
+
+
+# Run a model for a number of steps (or until it stops itself, after which
+# its final values are carried forward) and return its five series as an
+# array of shape (steps, series)
+def run_trajectory(model, steps):
+  for i in range(steps):
+    if not model.running:
+      break
+    model.step()
+  trajectory = np.array([model.datacollector.model_vars[name] for name in SERIES], dtype=np.float64).T
+  if len(trajectory) < steps:
+    trajectory = np.concatenate([trajectory, np.repeat(trajectory[-1:], steps - len(trajectory), axis=0)])
+  return trajectory
+
+
+# Fit the surrogate's contact and resolution rates to short runs of
+# Disease_Model with the given parameters (any not given keep their slider
+# defaults). The mean of the agent model's replicas is compared with the
+# surrogate's mean field, with each series scaled by its population, and the
+# rates are fitted by golden section search on each in turn (on a log scale).
+# Returns the fitted rates and the mean squared error of the fit.
+def calibrate(params=None, steps=30, replicas=10, seed=0, rounds=3):
+  from disease_model import Disease_Model
+  from disease_sweep import slider_defaults
+  params = dict(slider_defaults(), **(params or {}))
+  model_params = {name:value for name, value in params.items() if name not in ("stop_on_extinction", "stable_steps", "max_steps")}
+
+  target = np.mean([run_trajectory(Disease_Model(**model_params, seed=seed + i), steps) for i in range(replicas)], axis=0)
+  scale = np.array([params["N"], params["N"], params["rodent_population"], params["N"], params["N"]], dtype=float)
+
+  def error(rates):
+    model = Surrogate_Model(**model_params, method="mean_field", **rates)
+    return float(np.mean(((run_trajectory(model, steps) - target) / scale) ** 2))
+
+  bounds = {"contact_rate":(0.01, 50.0), "resolution_rate":(0.1, 20.0)}
+  rates = {"contact_rate":1.0, "resolution_rate":2.0}
+  ratio = (math.sqrt(5) - 1) / 2
+  for i in range(rounds):
+    for name, (low, high) in bounds.items():
+      def error_at(log_rate):
+        return error(dict(rates, **{name:math.exp(log_rate)}))
+      a, b = math.log(low), math.log(high)
+      c, d = b - ratio * (b - a), a + ratio * (b - a)
+      error_c, error_d = error_at(c), error_at(d)
+      for j in range(25):
+        if error_c < error_d:
+          b, d, error_d = d, c, error_c
+          c = b - ratio * (b - a)
+          error_c = error_at(c)
+        else:
+          a, c, error_c = c, d, error_d
+          d = a + ratio * (b - a)
+          error_d = error_at(d)
+      rates[name] = math.exp((a + b) / 2)
+  return dict(rates, error=error(rates))
+
+
+# Screen every combination of the given parameter values (a dict of
+# parameter name -> list of values; any not given keep their slider
+# defaults) with replicas runs of the surrogate each. Returns one row per
+# combination with the mean and standard deviation of the peak number of
+# infected humans and the final number of removed humans.
+#
+# With tau leaping or the mean field, every run of every combination is
+# advanced together, as one row of an array of counts, so screening
+# thousands of combinations takes about as many numpy calls as a single run.
+# Gillespie's method runs each one on its own.
+def screen(param_ranges, replicas=20, steps=100, seed=0, method="tau_leap", tau=0.25, **rates):
+  from disease_sweep import slider_defaults
+  names = list(param_ranges)
+  combinations = [dict(zip(names, values)) for values in itertools.product(*(param_ranges[name] for name in names))]
+  params = [dict(slider_defaults(), **combination) for combination in combinations]
+
+  if method == "gillespie":
+    seeds = np.random.SeedSequence(seed)
+    runs = np.stack([np.stack([run_trajectory(Surrogate_Model(**run_params, seed=int(child.generate_state(1)[0]),
+                                                              method=method, **rates), steps)
+                               for child in seeds.spawn(replicas)])
+                     for run_params in params])
+    peak_infected = runs[:, :, :, 0].max(axis=2)
+    final_removed = runs[:, :, -1, 4]
+  elif method in ("tau_leap", "mean_field"):
+    rng = None if method == "mean_field" else np.random.default_rng(seed)
+    constants = np.array([rate_constants(p["width"], p["height"], p["transmissibility"], p["mean_length_of_disease"],
+                                         p["treatment_chance"], p["environmental"], p["pesticide"], **rates)
+                          for p in params])
+    constants = np.repeat(constants[:, None, :], replicas, axis=1)
+    counts = initial_counts(np.array([p["N"] for p in params])[:, None],
+                            np.array([p["rodent_population"] for p in params])[:, None],
+                            np.array([p["initial_infection"] for p in params])[:, None] * np.ones(replicas), rng)
+    intervals = max(1, int(round(1 / tau)))
+    peak_infected = np.zeros(counts.shape[:-1])
+    for step in range(steps):
+      for i in range(intervals):
+        counts = leap(counts, constants, 1 / intervals, rng)
+      peak_infected = np.maximum(peak_infected, counts[..., I] + counts[..., IR])
+    final_removed = counts[..., R] + counts[..., SR] + counts[..., ER] + counts[..., IR]
+  else:
+    raise ValueError("Unknown method {!r}".format(method))
+
+  return pd.DataFrame([dict(combination, peak_infected_mean=peak.mean(), peak_infected_std=peak.std(),
+                            final_removed_mean=removed.mean(), final_removed_std=removed.std())
+                       for combination, peak, removed in zip(combinations, peak_infected, final_removed)])
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Screen interventions with a fast surrogate of the Lassa Fever model.")
+  parser.add_argument("--param", action="append", default=[], metavar="NAME=VALUES",
+                      help="parameter to screen, e.g. pesticide=0,10,20 or treatment_chance=10:50:10 (can be repeated)")
+  parser.add_argument("--replicas", type=int, default=20, help="surrogate runs per parameter combination")
+  parser.add_argument("--steps", type=int, default=100, help="steps per run")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--method", choices=["gillespie", "tau_leap", "mean_field"], default="tau_leap")
+  parser.add_argument("--calibrate", action="store_true", help="fit the surrogate's rates to short agent model runs first")
+  parser.add_argument("--out", default="screen.csv")
+  args = parser.parse_args()
+
+  from disease_sweep import parse_values
+  param_ranges = {}
+  for param in args.param:
+    name, values = param.split("=", 1)
+    param_ranges[name] = parse_values(values)
+
+  rates = {}
+  if args.calibrate:
+    fit = calibrate(seed=args.seed)
+    print("Calibrated: contact rate {contact_rate:.3f}, resolution rate {resolution_rate:.3f} (error {error:.5f})".format(**fit))
+    rates = {"contact_rate":fit["contact_rate"], "resolution_rate":fit["resolution_rate"]}
+
+  results = screen(param_ranges, args.replicas, args.steps, args.seed, args.method, **rates)
+  results.to_csv(args.out, index=False)
+  print(results.sort_values("peak_infected_mean").head(10).to_string(index=False))
+
+
+if __name__ == "__main__":
+  main()
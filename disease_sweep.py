@@ -0,0 +1,216 @@
+# Headless parameter sweeps over the Disease_Model. Rather than launching the
+# interactive server, this runs every combination of the parameter values we
+# ask for (each repeated for a number of replicas) across a pool of worker
+# processes, and writes the per-step results to a single tidy table with one
+# row per run per step.
+#
+# Example - sweep treatment chance and pesticide, 10 replicas each:
+#   python3 disease_sweep.py --param treatment_chance=10:50:10 --param pesticide=0,10,20 --replicas 10 --steps 200 --out sweep_results
+#
+# Each finished run is saved to its own part file as soon as it completes, so
+# a sweep that is interrupted (or whose workers crash) can be resumed by
+# running the same command again - finished runs are not redone.
+import argparse
+import inspect
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+from disease_collector import default_format, read_table, write_table
+from disease_model import Disease_Model
+
+# Name of the file recording what a sweep directory holds, so that resuming
+# with different settings is caught rather than mixing results
+MANIFEST_NAME = "sweep.json"
+
+
+# Settings the interactive server uses only for the sake of the display,
+# which sweeps leave at the model's own defaults
+DISPLAY_SETTINGS = ("prune_dead", "steps_per_frame")
+
+# The default value of every Disease_Model parameter, taken from the sliders
+# (and fixed values) set up for the interactive server in disease_server.py
+def slider_defaults():
+  from disease_server import server
+  return {name:getattr(value, "value", value) for name, value in server.model_kwargs.items()
+          if name not in DISPLAY_SETTINGS}
+
+
+# Turn a command line value range into a list of values. Accepts a single
+# value ("35"), a comma separated list ("0,10,20") or an inclusive
+# start:stop:step range ("10:50:10")
+def parse_values(text):
+  def number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+  if ":" in text:
+    start, stop, step = (number(part) for part in text.split(":"))
+    count = int(round((stop - start) / step)) + 1
+    return [number(round(start + i * step, 10)) for i in range(count)]
+  return [number(part) for part in text.split(",")]
+
+
+# Build the list of jobs for a sweep - one for every combination of
+# parameter values and replica. Each job gets its own seed, spawned from the
+# sweep's seed so that runs are independent but the whole sweep can be
+# reproduced.
+def build_jobs(param_ranges, replicas, seed):
+  params = slider_defaults()
+  unknown = set(param_ranges) - set(inspect.signature(Disease_Model).parameters)
+  if unknown:
+    raise ValueError("Unknown Disease_Model parameters: {}".format(", ".join(sorted(unknown))))
+
+  names = list(param_ranges)
+  combinations = list(itertools.product(*(param_ranges[name] for name in names)))
+  seeds = np.random.SeedSequence(seed).spawn(len(combinations) * replicas)
+
+  jobs = []
+  for values in combinations:
+    job_params = dict(params, **dict(zip(names, values)))
+    for replica in range(replicas):
+      job_id = len(jobs)
+      job_seed = int(seeds[job_id].generate_state(1)[0])
+      jobs.append({"job":job_id, "replica":replica, "seed":job_seed, "params":job_params})
+  return jobs
+
+
+# Run Disease_Model with the given parameters and seed, and return its
+# per-step results as a table. The run stops early if the model stops itself
+# (see Termination_Criteria), and its stop reason and step are recorded on
+# every row. Given a Result_Cache (see disease_cache.py), a run that's been
+# done before is read back from it instead, and a new one is added to it.
+def run_model(params, seed, steps, cache=None):
+  if cache is not None:
+    results = cache.get(params, seed, steps)
+    if results is not None:
+      return results
+
+  model = Disease_Model(**params, seed=seed)
+  while model.running and model.schedule.steps < steps:
+    model.step()
+
+  results = model.datacollector.get_model_vars_dataframe()
+  results.insert(0, "step", np.arange(1, len(results) + 1))
+  results["stop_reason"] = model.stop_reason
+  results["stop_step"] = model.stop_step
+  if cache is not None:
+    cache.put(params, seed, steps, results)
+  return results
+
+
+# Run a single job and return its results as a tidy table. This is what the
+# worker processes run.
+def run_job(job, steps, cache=None):
+  results = run_model(job["params"], job["seed"], steps, cache)
+  for name, value in reversed(list(job["params"].items())):
+    results.insert(0, name, value)
+  results.insert(0, "seed", job["seed"])
+  results.insert(0, "replica", job["replica"])
+  results.insert(0, "job", job["job"])
+  return results
+
+
+# Check the sweep directory matches the sweep we've been asked to run (or
+# start a new one), so a resumed sweep can't mix in results run with
+# different settings
+def check_manifest(out_dir, manifest):
+  path = os.path.join(out_dir, MANIFEST_NAME)
+  if os.path.exists(path):
+    with open(path) as f:
+      existing = json.load(f)
+    if existing != manifest:
+      raise ValueError("{} holds a different sweep; use a new output directory or the original settings".format(out_dir))
+  else:
+    with open(path, "w") as f:
+      json.dump(manifest, f, indent=2)
+
+
+# Run a parameter sweep. param_ranges maps Disease_Model parameter names to
+# lists of values to try; any parameter not given keeps its slider default.
+# Runs stop early if the model stops itself (by default the server's
+# settings stop a run once the disease has died out), and their stop reason
+# and step are recorded on every row.
+# Runs already in cache (a Result_Cache, if given) aren't run again.
+# Returns the path of the combined results file.
+def run_sweep(param_ranges, replicas=1, steps=100, seed=0, out_dir="sweep_results", workers=None, file_format=None, max_restarts=3, cache=None):
+  file_format = file_format or default_format()
+  jobs = build_jobs(param_ranges, replicas, seed)
+
+  parts_dir = os.path.join(out_dir, "parts")
+  os.makedirs(parts_dir, exist_ok=True)
+  check_manifest(out_dir, {"param_ranges":param_ranges, "replicas":replicas, "steps":steps,
+                           "seed":seed, "format":file_format})
+
+  def part_path(job):
+    return os.path.join(parts_dir, "job_{:06d}.{}".format(job["job"], file_format))
+
+  # Skip any jobs finished by an earlier, interrupted run of this sweep
+  remaining = [job for job in jobs if not os.path.exists(part_path(job))]
+  failed = {}
+  restarts = 0
+
+  while remaining:
+    still_remaining = []
+    pool_broken = False
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      futures = {pool.submit(run_job, job, steps, cache):job for job in remaining}
+      for future in as_completed(futures):
+        job = futures[future]
+        try:
+          write_table(future.result(), part_path(job))
+        except BrokenProcessPool:
+          # A worker died (e.g. killed or out of memory), which takes the
+          # whole pool down with it - the job will be retried in a new pool
+          pool_broken = True
+          still_remaining.append(job)
+        except Exception as error:
+          failed[job["job"]] = repr(error)
+
+    if pool_broken:
+      restarts += 1
+      if restarts > max_restarts:
+        raise RuntimeError("Worker pool crashed {} times; {} jobs unfinished. Rerun to resume.".format(restarts, len(still_remaining)))
+    remaining = still_remaining
+
+  if failed:
+    raise RuntimeError("{} jobs failed (rerun to retry them): {}".format(len(failed), failed))
+
+  results_path = os.path.join(out_dir, "results." + file_format)
+  write_table(pd.concat([read_table(part_path(job)) for job in jobs], ignore_index=True), results_path)
+  return results_path
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run a headless parameter sweep of the Lassa Fever model.")
+  parser.add_argument("--param", action="append", default=[], metavar="NAME=VALUES",
+                      help="parameter to sweep, e.g. pesticide=0,10,20 or treatment_chance=10:50:10 (can be repeated)")
+  parser.add_argument("--replicas", type=int, default=1, help="runs per parameter combination")
+  parser.add_argument("--steps", type=int, default=100, help="steps per run")
+  parser.add_argument("--seed", type=int, default=0, help="seed for the whole sweep")
+  parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+  parser.add_argument("--out", default="sweep_results", help="output directory")
+  parser.add_argument("--format", choices=["parquet", "csv"], default=None, help="output file format")
+  parser.add_argument("--cache", default=None, metavar="DIR", help="reuse runs cached in DIR, and cache new ones there")
+  parser.add_argument("--cache-size", type=float, default=1024, help="most disk space the cache can use, in MB")
+  args = parser.parse_args()
+
+  param_ranges = {}
+  for param in args.param:
+    name, values = param.split("=", 1)
+    param_ranges[name] = parse_values(values)
+
+  cache = None
+  if args.cache:
+    from disease_cache import Result_Cache
+    cache = Result_Cache(args.cache, int(args.cache_size * 1e6))
+  print(run_sweep(param_ranges, args.replicas, args.steps, args.seed, args.out, args.workers, args.format, cache=cache))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,50 @@
+import numpy as np
+
+# Timers for countdowns whose end is known as soon as they start (e.g. how
+# long an agent stays infected). Rather than counting every agent's timer
+# down by one each step to see whether it has run out, each agent is put in
+# the bucket for the step its timer runs out on, and each step only the
+# agents in that step's bucket are looked at.
+
+
+class Timer_Wheel:
+  def __init__(self):
+    self.buckets = {} # step -> list of arrays of agent indices
+
+  # Set timers for the given agents (an array of indices) to run out on the
+  # given steps (an array of the same length, or a single step)
+  def schedule(self, agents, steps):
+    if agents.size == 0:
+      return
+    steps = np.broadcast_to(steps, agents.shape)
+    order = np.argsort(steps, kind="stable")
+    agents = agents[order]
+    steps = steps[order]
+    unique_steps, starts = np.unique(steps, return_index=True)
+    for step, group in zip(unique_steps.tolist(), np.split(agents, starts[1:])):
+      self.buckets.setdefault(step, []).append(group)
+
+  # Remove and return the agents whose timers run out on step. An agent
+  # whose timer was reset after it was scheduled is still returned, so
+  # callers that reset timers should check the agents they get back.
+  def pop(self, step):
+    groups = self.buckets.pop(step, None)
+    if not groups:
+      return np.empty(0, dtype=np.int64)
+    return np.concatenate(groups)
+
+  # Follow the agents after the arrays they index have been rearranged:
+  # agent i becomes agent new_index[i], and agents whose new index is
+  # negative are dropped
+  def renumber(self, new_index):
+    for step in list(self.buckets):
+      groups = [new_index[group] for group in self.buckets[step]]
+      groups = [group[group >= 0] for group in groups]
+      groups = [group for group in groups if group.size]
+      if groups:
+        self.buckets[step] = groups
+      else:
+        del self.buckets[step]
+
+  def __len__(self):
+    return sum(group.size for groups in self.buckets.values() for group in groups)
@@ -0,0 +1,353 @@
+import sys
+
+import numpy as np
+from mesa import Model
+from mesa.datacollection import DataCollector
+
+from disease_collector import Streaming_DataCollector
+from disease_compare import compare_models, report_comparison
+from disease_model import Termination_Criteria, moore_neighbour_table
+from disease_timers import Timer_Wheel
+
+# An array-backed version of Disease_Model. Instead of creating one Python
+# object per human and rodent and stepping them one at a time, every piece of
+# agent state (position, compartment flags, disease and treatment countdowns)
+# is held in a NumPy array, and a whole group of agents is advanced at once
+# using batched random draws. The rules each agent follows are the same as in
+# Human_Agent.step and Rodent_Agent.step in disease_model.py.
+#
+# Agents aren't counted down one step at a time to see when their disease
+# ends. The step it ends on is known as soon as its length is drawn, so
+# each agent is put on a Timer_Wheel for that step, and each step only the
+# agents whose disease ends then are touched.
+
+
+class Vectorized_Disease_Model(Model):
+  """A model of how Lassa Fever spreads, with all agents stored in NumPy arrays so large populations can be stepped quickly."""
+  def __init__(self, N, width, height, initial_infection, transmissibility, level_of_movement, mean_length_of_disease, rodent_population, treatment_chance, treatment_length, isolation, environmental, pesticide, seed=None, activation_slots=4, stop_on_extinction=False, stable_steps=None, max_steps=None):
+    self.running = True # required for BatchRunner
+    self.num_humans = N
+    self.num_rodents = rodent_population
+    self.width = width
+    self.height = height
+    self.num_cells = width * height
+    # Flat indices of every cell's 8 neighbours (see moore_neighbour_table)
+    self.neighbour_cells = moore_neighbour_table(width, height)
+
+    # Parameters shared by every agent (the object-based model stores a copy
+    # of each of these on every agent)
+    self.transmissibility = transmissibility
+    self.level_of_movement = level_of_movement
+    self.mean_length_of_disease = mean_length_of_disease
+    self.treatment_chance = treatment_chance
+    self.treatment_length = treatment_length
+    self.isolation = isolation
+    self.environmental = environmental
+    self.pesticide = pesticide
+
+    # RandomActivation steps agents one at a time in a random order, so an
+    # agent can see changes made by agents activated before it in the same
+    # tick. We mimic this by dealing the agents out at random into a number
+    # of activation slots each tick, and running the slots one after another
+    # (see step below). More slots = closer to a fully random order.
+    self.activation_slots = activation_slots
+
+    self.rng = np.random.default_rng(seed)
+    self.steps = 0
+
+    # When to stop the run early, as in Disease_Model
+    self.termination = Termination_Criteria(stop_on_extinction, stable_steps, max_steps)
+    self.stop_reason = None
+    self.stop_step = None
+
+    # Human state. Positions are stored as flat cell indices
+    # (x * height + y) rather than (x, y) tuples.
+    self.human_pos = np.zeros(self.num_humans, dtype=np.int64)
+    self.human_infected = np.zeros(self.num_humans, dtype=bool)
+    self.human_susceptible = np.ones(self.num_humans, dtype=bool)
+    self.human_exposed = np.zeros(self.num_humans, dtype=bool)
+    self.human_removed = np.zeros(self.num_humans, dtype=bool)
+    # The step each infected human recovers on
+    self.human_recovery_step = np.zeros(self.num_humans, dtype=np.int64)
+    self.human_timers = Timer_Wheel()
+    # Rather than counting down every removed human's treatment/isolation
+    # each step, we record when each human was last removed and how many
+    # days of treatment they used up in earlier spells (see
+    # human_treat_lengths)
+    self.human_removed_since = np.zeros(self.num_humans, dtype=np.int64)
+    self.human_isolation_used = np.zeros(self.num_humans, dtype=np.int64)
+
+    # Rodent state. As in Rodent_Agent, each rodent is infected at the start
+    # with probability initial_infection.
+    self.rodent_pos = np.zeros(self.num_rodents, dtype=np.int64)
+    self.rodent_infected = self.rng.random(self.num_rodents) < initial_infection
+    self.rodent_susceptible = ~self.rodent_infected
+    self.rodent_death = np.zeros(self.num_rodents, dtype=bool)
+    # The step each infected rodent recovers on. A rodent's disease only
+    # counts down on steps it's active, so this is put back a step whenever
+    # environmental control holds it back.
+    self.rodent_recovery_step = np.zeros(self.num_rodents, dtype=np.int64)
+    infected = np.flatnonzero(self.rodent_infected)
+    self.rodent_recovery_step[infected] = self.recovery_steps(0, self.disease_lengths(infected.size))
+    self.rodent_timers = Timer_Wheel()
+    self.rodent_timers.schedule(infected, self.rodent_recovery_step[infected])
+
+    # Place humans then rodents on distinct empty cells while there are any
+    # left, and on random cells once the grid is full (the same result as
+    # calling grid.find_empty() for each agent in turn)
+    start_cells = self.place_agents(self.num_humans + self.num_rodents)
+    self.human_pos[:] = start_cells[:self.num_humans]
+    self.rodent_pos[:] = start_cells[self.num_humans:]
+
+    self.datacollector = DataCollector(
+      model_reporters={"Infected Humans":calculate_number_infected,
+                       "Susceptible Humans":calculate_number_susceptible,
+                       "Deceased Rodents":calculate_number_deceased,
+                       "Exposed Humans":calculate_number_exposed,
+                       "Removed/Recovered/Isolated Humans":calculate_number_removed},
+      agent_reporters={},
+      tables={"Termination":["Stop Reason", "Stop Step"]}
+      )
+
+  # Pick starting cells for n agents: distinct cells taken from a shuffled
+  # list of every cell, then random cells for any agents left over
+  def place_agents(self, n):
+    cells = self.rng.permutation(self.num_cells)[:n]
+    if n > self.num_cells:
+      cells = np.concatenate([cells, self.rng.integers(0, self.num_cells, n - self.num_cells)])
+    return cells
+
+  # Sample n disease durations, rounded to whole days as in the agent model
+  def disease_lengths(self, n):
+    return np.rint(self.rng.exponential(self.mean_length_of_disease, n)).astype(np.int64)
+
+  # The step on which a disease of the given lengths, starting on step now,
+  # ends. The agent model counts a disease down on the step it starts, and
+  # ends it once the count reaches zero, so a disease of length 0 or 1 ends
+  # on the step it starts.
+  def recovery_steps(self, now, lengths):
+    return now + np.maximum(lengths, 1) - 1
+
+  # Equivalent of random.randint(0, 100) < chance for n agents at once
+  def percent_chance(self, n, chance):
+    return self.rng.integers(0, 101, n) < chance
+
+  # Move each of the given flat cell indices to a randomly chosen cell in its
+  # Moore neighbourhood, wrapping around the edges of the grid (torus). The
+  # whole batch is looked up in the neighbour table at once.
+  def move(self, cells):
+    choice = self.rng.integers(0, self.neighbour_cells.shape[1], cells.size)
+    return self.neighbour_cells[cells, choice]
+
+  # Advance the humans with the given indices by one step (Human_Agent.step).
+  # due holds those of them whose disease ends this step.
+  def step_humans(self, humans, due):
+    now = self.steps
+    removed = self.human_removed[humans]
+
+    # Humans that aren't removed move with the given probability
+    moving = humans[~removed & (self.rng.random(humans.size) < self.level_of_movement)]
+    self.human_pos[moving] = self.move(self.human_pos[moving])
+
+    # Exposed humans are either treated (removed), become infected, or go
+    # back to being susceptible. They then get a second chance of treatment.
+    exposed = humans[self.human_exposed[humans]]
+    # The humans that may stop or start being removed this step, and whether
+    # they were removed at the start of it
+    changing = np.concatenate([exposed, due])
+    was_removed = self.human_removed[changing]
+    if exposed.size:
+      treated = self.percent_chance(exposed.size, self.treatment_chance)
+      infected = ~treated & (self.rng.random(exposed.size) < self.transmissibility)
+      self.human_exposed[exposed] = False
+      self.human_susceptible[exposed] = ~treated & ~infected
+      self.human_removed[exposed[treated]] = True
+
+      newly_infected = exposed[infected]
+      self.human_infected[newly_infected] = True
+      self.human_removed[newly_infected] = False
+      self.human_recovery_step[newly_infected] = self.recovery_steps(now, self.disease_lengths(newly_infected.size))
+
+      treated = exposed[self.percent_chance(exposed.size, self.treatment_chance)]
+      self.human_susceptible[treated] = False
+      self.human_removed[treated] = True
+
+      # Those whose disease ends this step recover along with the others
+      # below, and the rest are put on the timer wheel
+      later = self.human_recovery_step[newly_infected] > now
+      self.human_timers.schedule(newly_infected[later], self.human_recovery_step[newly_infected[later]])
+      due = np.concatenate([due, newly_infected[~later]])
+
+    # Infected humans whose disease has run its course are removed
+    self.human_infected[due] = False
+    self.human_susceptible[due] = False
+    self.human_removed[due] = True
+    self.update_isolation(changing, was_removed)
+
+  # Keep track of when humans' spells of treatment/isolation start and end
+  def update_isolation(self, humans, was_removed):
+    now = self.steps
+    now_removed = self.human_removed[humans]
+    # A removed human counts down their treatment at the start of each step,
+    # so one whose spell ends this step has counted down every step since it
+    # started, including this one
+    ended = humans[was_removed & ~now_removed]
+    self.human_isolation_used[ended] += now - self.human_removed_since[ended]
+    started = humans[~was_removed & now_removed]
+    self.human_removed_since[started] = now
+
+  # Each human's remaining treatment/isolation length - the treatment length,
+  # counted down by one on every step a human starts removed
+  def human_treat_lengths(self):
+    current = np.where(self.human_removed, self.steps - 1 - self.human_removed_since, 0)
+    return self.treatment_length - self.human_isolation_used - current
+
+  # Advance the rodents with the given indices by one step (Rodent_Agent.step).
+  # due holds those of them whose timers run out this step.
+  def step_rodents(self, rodents, due):
+    now = self.steps
+    # Pesticide kills rodents with the given chance
+    killed = rodents[self.percent_chance(rodents.size, self.pesticide)]
+    self.rodent_death[killed] = True
+    self.rodent_infected[killed] = False
+    self.rodent_susceptible[killed] = False
+
+    # Living rodents that aren't held back by environmental control move
+    # with the given probability
+    living = rodents[~self.rodent_death[rodents]]
+    held_back = self.percent_chance(living.size, self.environmental)
+    active = living[~held_back]
+    moving = active[self.rng.random(active.size) < self.level_of_movement]
+    self.rodent_pos[moving] = self.move(self.rodent_pos[moving])
+
+    self.expose(active[self.rodent_infected[active]])
+
+    # Infected rodents held back don't count down their disease this step,
+    # so their recovery is put back a step
+    held_back = living[held_back]
+    held_back = held_back[self.rodent_infected[held_back]]
+    if held_back.size:
+      self.rodent_recovery_step[held_back] += 1
+      self.rodent_timers.schedule(held_back, self.rodent_recovery_step[held_back])
+
+    # Rodents whose disease has run its course recover. Timers of rodents
+    # that have since died or been put back are out of date, and ignored.
+    due = due[self.rodent_infected[due] & (self.rodent_recovery_step[due] == now)]
+    self.rodent_infected[due] = False
+    self.rodent_susceptible[due] = True
+
+  # Infected rodents (the given indices) expose every human sharing their
+  # cell who isn't already infected
+  def expose(self, infected):
+    if infected.size:
+      infected_cells = np.zeros(self.num_cells, dtype=bool)
+      infected_cells[self.rodent_pos[infected]] = True
+      exposed = infected_cells[self.human_pos] & ~self.human_infected
+      self.human_exposed[exposed] = True
+      self.human_susceptible[exposed] = False
+
+  # Advance the given humans and rodents (arrays of indices) by one step.
+  # Each is dealt into a random activation slot, and the slots are run in
+  # order. Within a slot we toss a coin for whether the humans or the
+  # rodents go first, so on average a human exposed this tick resolves
+  # their exposure in the same tick half of the time, as with
+  # RandomActivation.
+  # The agents whose timers run out this step are handed to the slot each
+  # was dealt into (agents not given are in no slot, so are skipped).
+  def step_agents(self, humans, rodents):
+    human_slot = np.full(self.num_humans, -1)
+    human_slot[humans] = self.rng.integers(0, self.activation_slots, humans.size)
+    rodent_slot = np.full(self.num_rodents, -1)
+    rodent_slot[rodents] = self.rng.integers(0, self.activation_slots, rodents.size)
+    due_humans = self.human_timers.pop(self.steps)
+    due_human_slots = human_slot[due_humans]
+    due_rodents = self.rodent_timers.pop(self.steps)
+    due_rodent_slots = rodent_slot[due_rodents]
+    for slot in range(self.activation_slots):
+      slot_humans = humans[human_slot[humans] == slot]
+      slot_rodents = rodents[rodent_slot[rodents] == slot]
+      slot_due_humans = due_humans[due_human_slots == slot]
+      slot_due_rodents = due_rodents[due_rodent_slots == slot]
+      if self.rng.random() < 0.5:
+        self.step_humans(slot_humans, slot_due_humans)
+        self.step_rodents(slot_rodents, slot_due_rodents)
+      else:
+        self.step_rodents(slot_rodents, slot_due_rodents)
+        self.step_humans(slot_humans, slot_due_humans)
+
+  # Function to advance the model by one step
+  def step(self):
+    # Dead rodents are left out, as Disease_Model removes them from its
+    # schedule
+    self.step_agents(np.arange(self.num_humans), np.flatnonzero(~self.rodent_death))
+    self.steps += 1
+    self.datacollector.collect(self)
+
+    counts = (calculate_number_infected(self), calculate_number_susceptible(self), calculate_number_deceased(self),
+              calculate_number_exposed(self), calculate_number_removed(self))
+    self.termination.update(self, self.steps, counts, int(np.count_nonzero(self.rodent_infected)))
+
+  # Send the collected data to part files under path rather than keeping it
+  # all in memory, as in Disease_Model.stream_data (call finish_streaming
+  # once you've finished stepping the model)
+  def stream_data(self, path, buffer_steps=1000, agent_snapshot_every=None, file_format=None):
+    self.datacollector = Streaming_DataCollector(path, self.datacollector.model_reporters,
+                                                 {name:list(columns) for name, columns in self.datacollector.tables.items()},
+                                                 buffer_steps, agent_snapshot_every, file_format)
+
+  # Write out whatever the streaming datacollector still has buffered, as in
+  # Disease_Model.finish_streaming
+  def finish_streaming(self):
+    if isinstance(self.datacollector, Streaming_DataCollector):
+      self.datacollector.flush()
+
+  # The current state of every agent, as columns (humans first, then
+  # rodents, numbered the same way as in Disease_Model)
+  def agent_snapshot(self):
+    no_humans = np.zeros(self.num_humans, dtype=bool)
+    no_rodents = np.zeros(self.num_rodents, dtype=bool)
+    pos = np.concatenate([self.human_pos, self.rodent_pos])
+    return {"unique_id":np.arange(self.num_humans + self.num_rodents),
+            "is_human":np.concatenate([~no_humans, no_rodents]),
+            "x":pos // self.height, "y":pos % self.height,
+            "infected":np.concatenate([self.human_infected, self.rodent_infected]),
+            "susceptible":np.concatenate([self.human_susceptible, self.rodent_susceptible]),
+            "exposed":np.concatenate([self.human_exposed, no_rodents]),
+            "removed":np.concatenate([self.human_removed, no_rodents]),
+            "death":np.concatenate([no_humans, self.rodent_death])}
+
+# Model reporters - these give the same five series as the reporters in
+# disease_model.py, counted straight from the state arrays
+def calculate_number_infected(model):
+  return int(np.count_nonzero(model.human_infected))
+
+def calculate_number_susceptible(model):
+  return int(np.count_nonzero(model.human_susceptible))
+
+def calculate_number_deceased(model):
+  return int(np.count_nonzero(model.rodent_death))
+
+def calculate_number_exposed(model):
+  return int(np.count_nonzero(model.human_exposed))
+
+def calculate_number_removed(model):
+  return int(np.count_nonzero(model.human_removed))
+
+
+# Statistical equivalence check against the object-based model (see
+# compare_models in disease_compare.py). Run this file to check it, exiting
+# with status 1 if any series differs.
+def compare_with_agent_model(replicas=50, steps=100, tolerance=0.01, seed=0, **params):
+  from disease_model import Disease_Model
+
+  model_params = {"N":200, "width":20, "height":20, "initial_infection":0.9,
+                  "transmissibility":1, "level_of_movement":0.56,
+                  "mean_length_of_disease":18, "rodent_population":200,
+                  "treatment_chance":35, "treatment_length":40, "isolation":60,
+                  "environmental":0, "pesticide":0}
+  model_params.update(params)
+  return compare_models(Disease_Model, Vectorized_Disease_Model, model_params, replicas, steps, tolerance, seed)
+
+
+if __name__ == "__main__":
+  sys.exit(report_comparison(compare_with_agent_model()))